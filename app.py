@@ -1,36 +1,68 @@
-import os
-import pandas as pd
 import json
+import logging
+import os
+import tempfile
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, File, UploadFile, HTTPException, Header, Depends
-from fastapi.responses import JSONResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import List
-from src.data import extract_table_from_pdf, parse_transactions, classify_company, execute_query_and_display
-from src.report import generate_bank_statement_report
 from dotenv import load_dotenv
-import random
-from fastapi.middleware.cors import CORSMiddleware
-from apps.run_chain import run_chain
-from apps.upload_file import upload_file
-from apps.upload_file import generate_sqldb
-import openai
-from langchain_openai import ChatOpenAI
-import os
+from apps.jobs import upload_jobs, QueueFull
 import uvicorn
 
-#initilise llm
-llm = ChatOpenAI(
-    model="tiiuae/falcon-180B-chat",
-    api_key=os.getenv("AI71_API_KEY"),
-    base_url="https://api.ai71.ai/v1/",
-    temperature=0,
-)
+load_dotenv()
 
-generate_sqldb()
+# The ingest pipeline (pdfplumber, pandas) and the chat chain are
+# imported on first use, so the server binds its port right away
 
-load_dotenv()
+startup_job = None
+
+
+def prepare_database(progress):
+    from apps.upload_file import refresh_sqldb
+    refresh_sqldb(progress=progress)
+    # Load the chat chain too, so the first question does not pay for it
+    progress('loading chat chain')
+    import apps.run_chain
+
+
+def answer_question(question):
+    from apps.run_chain import run_chain
+    return run_chain(question)
+
+
+def report_content():
+    from apps import db
+    from src.report import generate_rollup_report
+    conn = db.connect()
+    try:
+        return generate_rollup_report(conn, markdown=False)
+    finally:
+        conn.close()
+
+
+def answer_events(question):
+    # A sync generator: the server iterates it in its thread pool
+    from apps.run_chain import stream_chain
+    try:
+        for event, data in stream_chain(question):
+            yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+    except Exception as e:
+        logging.exception("Streaming answer failed")
+        yield f"event: error\ndata: {json.dumps({'detail': str(e)})}\n\n"
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app):
+    # Reload the saved statement in the background, only if it changed
+    global startup_job
+    startup_job = upload_jobs.submit(prepare_database, keep=True)
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -57,23 +89,79 @@ def verify_token(x_token: str = Header(...)) -> None:
 def greet_json():
     return {"Spendwise APIs"}
 
+@app.get("/metrics")
+def metrics():
+    # Prometheus text format: stage timings, counts and errors of uploads and questions
+    from src.metrics import registry
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/ready")
+def ready():
+    job = upload_jobs.get(startup_job) if startup_job else None
+    if job is None or job['status'] in ('queued', 'running'):
+        return JSONResponse(status_code=503, content={"ready": False, "startup": job})
+    return JSONResponse(content={"ready": True, "startup": job})
+
+
+def process_upload(progress, pdf_path):
+    from apps.upload_file import upload_file
+    try:
+        upload_file(pdf_path, progress)
+    finally:
+        # The tables extract_table_from_pdf saved next to the statement go too
+        table_path = os.path.splitext(pdf_path)[0] + '.parquet'
+        for path in (pdf_path, table_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
 @app.post("/upload_pdf/")
 async def upload_pdf(file: UploadFile = File(...), x_token: str = Depends(verify_token)):
     if not file.filename.endswith('.pdf'):
         raise HTTPException(status_code=400, detail="Invalid file type. Only PDF files are accepted.")
-    pdf_path = f'/tmp/bank_statement.pdf'
-    with open(pdf_path, "wb") as buffer:
+    # Each upload gets its own file, several can be processed at once
+    fd, pdf_path = tempfile.mkstemp(prefix='bank_statement_', suffix='.pdf')
+    with os.fdopen(fd, "wb") as buffer:
         buffer.write(await file.read())
-    upload_file(pdf_path)
-    return JSONResponse(content={"message": "PDF processed successfully.", "sample_table": '', "report_content": 'breakdown my expenditure by category'})
+    # Processing happens in the background, poll /jobs/{job_id} for its status
+    try:
+        job_id = upload_jobs.submit(process_upload, pdf_path)
+    except QueueFull:
+        os.remove(pdf_path)
+        raise HTTPException(status_code=429, detail="Too many statements are being processed, try again later.")
+    return JSONResponse(content={"message": "PDF received, processing started.", "job_id": job_id, "status_url": f"/jobs/{job_id}", "sample_table": '', "report_content": 'breakdown my expenditure by category'})
+
+
+@app.get("/jobs/{job_id}")
+def job_status(job_id: str, x_token: str = Depends(verify_token)):
+    job = upload_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job id")
+    return JSONResponse(content=job)
+
+
+@app.get("/report")
+async def report(x_token: str = Depends(verify_token)):
+    # Read from the rollup tables maintained at ingest, not from the transactions
+    content = await run_in_threadpool(report_content)
+    return JSONResponse(content=content)
 
 
 @app.post("/ask/")
 async def ask_question(request: QueryRequest, x_token: str = Depends(verify_token)):
-    results = run_chain(request.question)
+    # run_chain blocks on the LLM, keep it off the event loop
+    results = await run_in_threadpool(answer_question, request.question)
     return JSONResponse(content={"message": '', "response": results})
 
 
+@app.post("/ask/stream")
+async def ask_question_stream(request: QueryRequest, x_token: str = Depends(verify_token)):
+    # Server-sent events: 'sql' and 'rows' stages, the answer 'token' by token, then 'done'
+    return StreamingResponse(answer_events(request.question), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 if __name__ == "__main__":
     
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,205 @@
+import logging
+import sqlite3
+
+DB_PATH = 'expenses.db'
+
+# Bumped whenever the schema below changes, see migrate()
+SCHEMA_VERSION = 3
+
+EXPENSE_COLUMNS = ['Merchant', 'Location', 'Date', 'Amount', 'Transaction ID', 'Category_freetext', 'Category']
+
+# Dates are stored as 'YYYY-MM-DD HH:MM:SS' text, the format SQLite date functions
+# understand and that sorts chronologically
+EXPENSES_TABLE = """
+    CREATE TABLE IF NOT EXISTS expenses (
+        "Merchant" TEXT NOT NULL,
+        "Location" TEXT,
+        "Date" TIMESTAMP NOT NULL CHECK (datetime("Date") IS NOT NULL),
+        "Amount" REAL NOT NULL,
+        "Transaction ID" TEXT,
+        "Category_freetext" TEXT,
+        "Category" TEXT
+    )"""
+
+# Key/value facts about the data, e.g. which statement was loaded last
+META_TABLE = """
+    CREATE TABLE IF NOT EXISTS meta (
+        "key" TEXT PRIMARY KEY,
+        "value" TEXT
+    )"""
+
+EXPENSES_INDEXES = [
+    # A transaction is identified by its id, date and amount
+    'CREATE UNIQUE INDEX IF NOT EXISTS expenses_transaction ON expenses ("Transaction ID", "Date", "Amount")',
+    # Covering indexes for the sums by category / date range / merchant the chatbot asks for
+    'CREATE INDEX IF NOT EXISTS expenses_category ON expenses ("Category", "Date", "Amount")',
+    'CREATE INDEX IF NOT EXISTS expenses_date ON expenses ("Date", "Amount")',
+    'CREATE INDEX IF NOT EXISTS expenses_merchant ON expenses ("Merchant", "Amount")',
+]
+
+# Totals of the expenses by category, merchant and month, kept up to date by
+# triggers as rows are inserted or deleted, so reports do not scan the table
+ROLLUP_TABLES = {
+    'category_totals': ('Category', '{row}."Category"'),
+    'merchant_totals': ('Merchant', '{row}."Merchant"'),
+    'monthly_totals': ('Month', 'strftime(\'%Y-%m\', {row}."Date")'),
+}
+
+
+def _rollup_statements():
+    statements = []
+    inserted, deleted = [], []
+    for table, (key, expression) in ROLLUP_TABLES.items():
+        statements.append(f"""
+    CREATE TABLE IF NOT EXISTS {table} (
+        "{key}" TEXT PRIMARY KEY,
+        "Amount" REAL NOT NULL,
+        "Transactions" INTEGER NOT NULL
+    )""")
+        statements.append(f'CREATE INDEX IF NOT EXISTS {table}_amount ON {table} ("Amount")')
+        new, old = expression.format(row='NEW'), expression.format(row='OLD')
+        inserted.append(f"""
+        INSERT INTO {table} SELECT {new}, NEW."Amount", 1 WHERE {new} IS NOT NULL
+        ON CONFLICT("{key}") DO UPDATE SET "Amount" = "Amount" + excluded."Amount",
+            "Transactions" = "Transactions" + 1;""")
+        deleted.append(f"""
+        UPDATE {table} SET "Amount" = "Amount" - OLD."Amount", "Transactions" = "Transactions" - 1
+        WHERE "{key}" = {old};
+        DELETE FROM {table} WHERE "{key}" = {old} AND "Transactions" <= 0;""")
+    statements.append(f"""
+    CREATE TRIGGER IF NOT EXISTS expenses_rollup_insert AFTER INSERT ON expenses BEGIN{''.join(inserted)}
+    END""")
+    statements.append(f"""
+    CREATE TRIGGER IF NOT EXISTS expenses_rollup_delete AFTER DELETE ON expenses BEGIN{''.join(deleted)}
+    END""")
+    return statements
+
+
+ROLLUP_STATEMENTS = _rollup_statements()
+
+
+def connect(path=DB_PATH):
+    """Open the expenses database, creating or migrating its schema if needed."""
+    conn = sqlite3.connect(path, timeout=30)
+    # Let readers (the chatbot) query while an upload is being written
+    conn.execute('PRAGMA journal_mode=WAL')
+    migrate(conn)
+    return conn
+
+
+def _table_columns(conn, table):
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+
+
+def migrate(conn):
+    """
+    Bring the schema of the database to SCHEMA_VERSION, one version at a time.
+    """
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version >= SCHEMA_VERSION:
+        return
+
+    with conn:
+        if version < 1:
+            _migrate_expenses(conn, version)
+        if version < 2:
+            conn.execute(META_TABLE)
+        if version < 3:
+            for statement in ROLLUP_STATEMENTS:
+                conn.execute(statement)
+            rebuild_rollups(conn)
+        conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+
+def _migrate_expenses(conn, version):
+    """
+    Create the typed expenses table, copying the rows of a table created by
+    DataFrame.to_sql (without types or indexes) if there is one.
+
+    Rows without a transaction id are dropped: nothing could tell them apart
+    from the same rows ingested again, and that table was always rebuilt
+    from data/bank_statement.pdf, which refresh_sqldb ingests at startup.
+    """
+    old_columns = _table_columns(conn, 'expenses')
+    if old_columns:
+        logging.info(f"Migrating the expenses table from schema version {version}")
+        conn.execute('DROP INDEX IF EXISTS expenses_transaction')
+        conn.execute('ALTER TABLE expenses RENAME TO expenses_old')
+    conn.execute(EXPENSES_TABLE)
+    for index in EXPENSES_INDEXES:
+        conn.execute(index)
+    if old_columns and 'Transaction ID' not in old_columns:
+        logging.warning("The old expenses table has no transaction ids, its rows are not copied")
+        conn.execute('DROP TABLE expenses_old')
+    elif old_columns:
+        selected = []
+        for column in EXPENSE_COLUMNS:
+            if column not in old_columns:
+                selected.append('NULL')
+            elif column == 'Date':
+                selected.append('datetime("Date")')
+            else:
+                selected.append(f'"{column}"')
+        columns = ', '.join(f'"{column}"' for column in EXPENSE_COLUMNS)
+        conn.execute(f'INSERT OR IGNORE INTO expenses ({columns}) SELECT {", ".join(selected)} '
+                     f'FROM expenses_old WHERE "Merchant" IS NOT NULL AND datetime("Date") IS NOT NULL '
+                     f'AND "Amount" IS NOT NULL AND "Transaction ID" IS NOT NULL')
+        dropped = conn.execute('SELECT COUNT(*) FROM expenses_old WHERE "Transaction ID" IS NULL').fetchone()[0]
+        if dropped:
+            logging.warning(f"Dropped {dropped} old expenses without a transaction id")
+        conn.execute('DROP TABLE expenses_old')
+
+
+def rebuild_rollups(conn):
+    """Recompute the rollup tables from the expenses table."""
+    for table, (key, expression) in ROLLUP_TABLES.items():
+        value = expression.format(row='expenses')
+        conn.execute(f'DELETE FROM {table}')
+        conn.execute(f'INSERT INTO {table} SELECT {value}, SUM("Amount"), COUNT(*) FROM expenses '
+                     f'WHERE {value} IS NOT NULL GROUP BY {value}')
+
+
+def get_meta(conn, key):
+    row = conn.execute('SELECT "value" FROM meta WHERE "key" = ?', (key,)).fetchone()
+    return row[0] if row else None
+
+
+def set_meta(conn, key, value):
+    conn.execute('INSERT OR REPLACE INTO meta ("key", "value") VALUES (?, ?)', (key, value))
+
+
+def reset(conn):
+    """Remove all the transactions."""
+    with conn:
+        conn.execute('DELETE FROM expenses')
+
+
+def _sql_dates(dates):
+    # Same text format as DataFrame.to_sql uses for timestamps
+    return dates.dt.strftime('%Y-%m-%d %H:%M:%S')
+
+
+# function to keep only the transactions not stored yet
+def new_transactions(conn, df):
+    ids = df['Transaction ID'].dropna().unique().tolist()
+    existing = set()
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        placeholders = ', '.join('?' * len(chunk))
+        existing.update(conn.execute(
+            f'SELECT "Transaction ID", "Date", "Amount" FROM expenses WHERE "Transaction ID" IN ({placeholders})',
+            chunk))
+    keys = zip(df['Transaction ID'], _sql_dates(df['Date']), df['Amount'])
+    return df[[key not in existing for key in keys]]
+
+
+# function to insert transactions, skipping the ones already stored
+def insert_expenses(conn, df):
+    rows = df.reindex(columns=EXPENSE_COLUMNS).assign(Date=_sql_dates(df['Date']))
+    rows = rows.astype(object).where(rows.notna(), None)
+    columns = ', '.join(f'"{column}"' for column in EXPENSE_COLUMNS)
+    placeholders = ', '.join('?' * len(EXPENSE_COLUMNS))
+    # rowcount leaves out the changes made by the rollup triggers
+    cursor = conn.executemany(f'INSERT OR IGNORE INTO expenses ({columns}) VALUES ({placeholders})',
+                              rows.itertuples(index=False, name=None))
+    return cursor.rowcount
@@ -0,0 +1,206 @@
+import calendar
+import re
+from collections import namedtuple
+from src.cache import normalize_question
+from src.classifier import CATEGORIES
+
+# Words users say for the categories of the expenses table
+CATEGORY_SYNONYMS = {
+    'food': ['groceries', 'restaurants and cafes', 'food delivery'],
+    'eating out': ['restaurants and cafes'],
+    'dining': ['restaurants and cafes'],
+    'restaurant': ['restaurants and cafes'],
+    'restaurants': ['restaurants and cafes'],
+    'cafe': ['restaurants and cafes'],
+    'cafes': ['restaurants and cafes'],
+    'coffee': ['restaurants and cafes'],
+    'grocery': ['groceries'],
+    'supermarket': ['groceries'],
+    'delivery': ['food delivery'],
+    'gym': ['fitness'],
+    'sports': ['fitness'],
+    'health': ['healthcare'],
+    'medical': ['healthcare'],
+    'pharmacy': ['healthcare'],
+    'clothes': ['clothing'],
+    'fashion': ['clothing'],
+    'jewellery': ['jewelry'],
+    'transport': ['transportation'],
+    'taxi': ['transportation'],
+    'taxis': ['transportation'],
+    'fuel': ['transportation'],
+    'petrol': ['transportation'],
+    'phone': ['phone and internet'],
+    'mobile': ['phone and internet'],
+    'internet': ['phone and internet'],
+    'telecom': ['phone and internet'],
+    'online shopping': ['e-commerce'],
+    'ecommerce': ['e-commerce'],
+    'shopping': ['clothing', 'e-commerce', 'jewelry'],
+    **{category: [category] for category in CATEGORIES},
+}
+
+MONTHS = {name.lower(): number for number, name in enumerate(calendar.month_name) if name}
+MONTHS.update({name.lower(): number for number, name in enumerate(calendar.month_abbr) if name})
+
+BIGGEST_WORDS = {'biggest', 'largest', 'highest', 'most expensive', 'top', 'costliest'}
+BREAKDOWN_WORDS = {'breakdown', 'break down', 'by category', 'per category', 'each category', 'categories',
+                   'summary', 'summarize', 'summarise', 'report'}
+# Words that show the question is about amounts spent ('how much ...')
+SPEND_WORDS = {'spend', 'spent', 'spending', 'expense', 'expenses', 'expenditure', 'expenditures', 'pay', 'paid',
+               'total', 'much', 'purchase', 'purchases', 'transaction', 'transactions', 'payment', 'payments'}
+
+# Words that do not change the meaning of a question. A question with any
+# other word left over is not understood, and is left to the LLM.
+FILLER_WORDS = {'how', 'did', 'do', 'does', 'i', 've', 'have', 'has', 'had', 'my', 'me', 'what', 'whats',
+                's', 'is', 'was', 'were', 'are', 'the', 'a', 'an', 'of', 'on', 'in', 'for', 'at', 'during', 'to',
+                'overall', 'all', 'altogether', 'money', 'aed', 'dirhams', 'show', 'tell', 'give', 'please', 'can',
+                'could', 'you', 'so', 'far', 'by', 'category', 'single', 'ever', 'made', 'make', 'it', 'one',
+                'amount', 'up', 'sum', 'there', 'which'}
+
+Intent = namedtuple('Intent', ['name', 'categories', 'month', 'year', 'term'])
+LocalAnswer = namedtuple('LocalAnswer', ['intent', 'query', 'rows', 'text'])
+
+
+def _phrase_pattern(phrases):
+    phrases = sorted(phrases, key=len, reverse=True)
+    return re.compile(r'(?<![\w-])(' + '|'.join(re.escape(phrase) for phrase in phrases) + r')(?![\w-])')
+
+
+_CATEGORY_PATTERN = _phrase_pattern(CATEGORY_SYNONYMS)
+_KEYWORD_PATTERN = _phrase_pattern(BIGGEST_WORDS | BREAKDOWN_WORDS)
+
+
+def match_intent(question):
+    """
+    Recognise the common spending questions that can be answered without the LLM.
+
+    Returns:
+        Intent: The question family ('total', 'category_total', 'by_category',
+        'biggest' or 'top_category') and its slots, or None if the question is
+        not one of them.
+    """
+    text = normalize_question(question)
+
+    terms = _CATEGORY_PATTERN.findall(text)
+    text = _CATEGORY_PATTERN.sub(' ', text)
+    keywords = set(_KEYWORD_PATTERN.findall(text))
+    text = _KEYWORD_PATTERN.sub(' ', text)
+
+    month = year = None
+    leftover = []
+    for word in text.split():
+        if word in MONTHS and month is None:
+            month = MONTHS[word]
+        elif re.fullmatch(r'20\d\d', word) and year is None:
+            year = int(word)
+        elif word not in FILLER_WORDS and word not in SPEND_WORDS:
+            leftover.append(word)
+    # More than one category, a merchant, a relative date, a comparison...
+    if leftover or len(set(terms)) > 1:
+        return None
+
+    categories = CATEGORY_SYNONYMS[terms[0]] if terms else None
+    term = terms[0] if terms else None
+    if keywords & BIGGEST_WORDS:
+        if keywords & BREAKDOWN_WORDS:
+            return None
+        # 'top category' asks for a category, not for a purchase
+        if 'category' in text.split():
+            return Intent('top_category', categories, month, year, term)
+        return Intent('biggest', categories, month, year, term)
+    if keywords & BREAKDOWN_WORDS:
+        return Intent('by_category', categories, month, year, term)
+    if not SPEND_WORDS & set(normalize_question(question).split()):
+        return None
+    if categories:
+        return Intent('category_total', categories, month, year, term)
+    return Intent('total', None, month, year, term)
+
+
+def _filters(intent):
+    conditions, params = [], []
+    if intent.categories:
+        conditions.append(f'"Category" IN ({", ".join("?" * len(intent.categories))})')
+        params.extend(intent.categories)
+    if intent.month is not None and intent.year is not None:
+        # A date range, so the date index is used
+        next_year, next_month = (intent.year + 1, 1) if intent.month == 12 else (intent.year, intent.month + 1)
+        conditions.append('"Date" >= ? AND "Date" < ?')
+        params.extend([f'{intent.year}-{intent.month:02d}-01', f'{next_year}-{next_month:02d}-01'])
+    elif intent.year is not None:
+        conditions.append('"Date" >= ? AND "Date" < ?')
+        params.extend([f'{intent.year}-01-01', f'{intent.year + 1}-01-01'])
+    elif intent.month is not None:
+        conditions.append('strftime(\'%m\', "Date") = ?')
+        params.append(f'{intent.month:02d}')
+    return (' WHERE ' + ' AND '.join(conditions) if conditions else ''), params
+
+
+def build_query(intent):
+    """
+    Returns:
+        tuple: The parameterized SQL query answering the intent, and its parameters.
+    """
+    where, params = _filters(intent)
+    if intent.name == 'total':
+        query = f'SELECT SUM("Amount") FROM expenses{where}'
+    elif intent.name == 'biggest':
+        query = f'SELECT "Merchant", "Date", "Amount", "Category" FROM expenses{where} ORDER BY "Amount" DESC LIMIT 1'
+    elif intent.name == 'top_category' and not where:
+        # Kept up to date by the rollup triggers, see apps/db.py
+        query = 'SELECT "Category", "Amount" FROM category_totals ORDER BY "Amount" DESC LIMIT 1'
+    elif intent.name == 'top_category':
+        query = (f'SELECT "Category", SUM("Amount") FROM expenses{where} AND "Category" IS NOT NULL '
+                 f'GROUP BY "Category" ORDER BY SUM("Amount") DESC LIMIT 1')
+    else:
+        query = (f'SELECT "Category", SUM("Amount") FROM expenses{where} '
+                 f'GROUP BY "Category" ORDER BY SUM("Amount") DESC')
+    return query, params
+
+
+def _aed(amount):
+    return f"{amount:,.2f} AED"
+
+
+def format_answer(intent, rows):
+    """Write the answer to an intent from the rows of its query."""
+    scope = f" on {intent.term}" if intent.term else ''
+    if intent.month is not None:
+        scope += f" in {calendar.month_name[intent.month]}"
+    if intent.year is not None:
+        scope += f" {intent.year}" if intent.month is not None else f" in {intent.year}"
+
+    # The amount is the last column, except for the biggest purchase (merchant, date, amount, category)
+    amount_column = 2 if intent.name == 'biggest' else -1
+    if not rows or rows[0][amount_column] is None:
+        return f"You have not made any expense{scope}."
+    if intent.name == 'total':
+        return f"You spent {_aed(rows[0][0])}{scope}."
+    if intent.name == 'biggest':
+        merchant, date, amount, category = rows[0]
+        return f"Your biggest purchase{scope} was {_aed(amount)} at {merchant} on {date[:10]} ({category or 'uncategorized'})."
+    if intent.name == 'top_category':
+        category, amount = rows[0]
+        return f"Your top spending category{scope} was {category}, with {_aed(amount)}."
+
+    total = sum(amount for _, amount in rows)
+    if intent.name == 'category_total' and len(rows) == 1:
+        return f"You spent {_aed(total)}{scope}."
+    lines = [f"- {category}: {_aed(amount)}" for category, amount in rows]
+    return f"You spent {_aed(total)}{scope}:\n" + '\n'.join(lines)
+
+
+# function to answer a common question from the database, without the LLM
+def answer_locally(question, conn):
+    """
+    Returns:
+        LocalAnswer: The intent, the query that ran, its rows and the answer,
+        or None if the question is not a known intent.
+    """
+    intent = match_intent(question)
+    if intent is None:
+        return None
+    query, params = build_query(intent)
+    rows = conn.execute(query, params).fetchall()
+    return LocalAnswer(intent, query, rows, format_answer(intent, rows))
@@ -0,0 +1,89 @@
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# Uploads processed at the same time, and uploads allowed to wait for a worker
+UPLOAD_WORKERS = int(os.getenv('SPENDWISE_UPLOAD_WORKERS', 2))
+UPLOAD_QUEUE_SIZE = int(os.getenv('SPENDWISE_UPLOAD_QUEUE_SIZE', 20))
+
+# Finished jobs kept for the status endpoint
+MAX_FINISHED_JOBS = 1000
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobQueue:
+    """
+    Runs jobs in a bounded thread pool and keeps track of their status.
+
+    A job function is called with a `progress(stage, fraction=None)` callback
+    as first argument, which it uses to report what it is doing.
+    """
+
+    def __init__(self, workers=UPLOAD_WORKERS, max_pending=UPLOAD_QUEUE_SIZE):
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def _update(self, job_id, **fields):
+        with self._lock:
+            self._jobs[job_id].update(fields, updated_at=time.time())
+
+    def _run(self, job_id, func, args):
+        def progress(stage, fraction=None):
+            self._update(job_id, stage=stage, progress=fraction)
+
+        self._update(job_id, status='running')
+        try:
+            func(progress, *args)
+            self._update(job_id, status='done', stage='done', progress=1.0)
+        except Exception as e:
+            logging.exception(f"Job {job_id} failed")
+            self._update(job_id, status='failed', error=str(e))
+
+    def _prune(self):
+        finished = [job for job in self._jobs.values() if job['status'] in ('done', 'failed') and not job['keep']]
+        finished.sort(key=lambda job: job['updated_at'])
+        for job in finished[:max(len(finished) - MAX_FINISHED_JOBS, 0)]:
+            del self._jobs[job['id']]
+
+    def submit(self, func, *args, keep=False):
+        """
+        Queue `func(progress, *args)`.
+
+        Args:
+            keep (bool): Never prune the status of this job, e.g. the startup
+                job /ready reports on.
+
+        Returns:
+            str: The job id.
+
+        Raises:
+            QueueFull: If `max_pending` jobs are already waiting or running.
+        """
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            pending = sum(job['status'] in ('queued', 'running') for job in self._jobs.values())
+            if pending >= self.max_pending:
+                raise QueueFull(f"{pending} jobs are already pending")
+            self._prune()
+            self._jobs[job_id] = {'id': job_id, 'status': 'queued', 'stage': 'queued', 'progress': 0.0,
+                                  'error': None, 'created_at': now, 'updated_at': now, 'keep': keep}
+        self._executor.submit(self._run, job_id, func, args)
+        return job_id
+
+    def get(self, job_id):
+        """Return a copy of the status of a job, or None if it is unknown."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+
+upload_jobs = JobQueue()
@@ -1,19 +1,35 @@
-from langchain import PromptTemplate, LLMChain
-from langchain.chat_models import ChatOpenAI
-import openai
-import os
+import logging
 import re
-from langchain_openai import ChatOpenAI
-from langchain.schema import HumanMessage, SystemMessage
-from langchain_community.utilities import SQLDatabase
+import sqlite3
+import threading
 from dotenv import load_dotenv
+from src.cache import sql_cache, text_version
+from src.llm import gateway
+from src.metrics import count, stage, timed
+from apps.db import DB_PATH, SCHEMA_VERSION
+from apps.intents import answer_locally
 load_dotenv()
 
-llm=ChatOpenAI( model="tiiuae/falcon-180B-chat",
-    api_key= os.getenv("AI71_API_KEY"),
-    base_url="https://api.ai71.ai/v1/",
-    temperature=0,
-    )
+CHAT_MODEL = "tiiuae/falcon-180B-chat"
+
+# Connections to expenses.db, opened once per thread
+_local = threading.local()
+
+
+def get_connection():
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, timeout=30)
+        # The generated SQL must never modify the data
+        conn.execute('PRAGMA query_only = ON')
+        _local.conn = conn
+    return conn
+
+
+# function to run a query and return its rows as text (empty if there are none)
+def run_query(query):
+    rows = get_connection().execute(query).fetchall()
+    return str(rows) if rows else ''
 
 
 def clean_sql_query(query):
@@ -22,18 +38,8 @@ def clean_sql_query(query):
     return cleaned_query.strip()
 
 
-def chatbot(user_input):
-    try:
-        # Initialize the ChatOpenAI
-        llm = ChatOpenAI(
-            model="tiiuae/falcon-180B-chat",
-            api_key=os.getenv("AI71_API_KEY"),
-            base_url="https://api.ai71.ai/v1/",
-            temperature=0,
-        )
-        db = SQLDatabase.from_uri("sqlite:///expenses.db")
-        # Define the template for the prompt
-        template = """
+# Define the template for the prompt
+SQL_PROMPT_TEMPLATE = """
         You are an intelligent MySQL chatbot and your name is SpendWise who will talk about expense history. Help the following question with a brilliant answer. Get the expense data from SQL database named 'expenses'.
         Columns in 'expenses' table:
         CREATE TABLE expenses (
@@ -41,6 +47,7 @@ def chatbot(user_input):
 	          "Location" TEXT,
 	          "Date" TIMESTAMP,
 	          "Amount" REAL,
+	          "Transaction ID" TEXT,
 	          "Category_freetext" TEXT,
 	          "Category" TEXT
         ) Make SQL query according to question and the different categories are 'fitness', 'groceries', 'restaurants and cafes', 'healthcare', 'clothing', 'jewelry', 'transportation', 'phone and internet', 'miscellaneous', 'others', 'e-commerce', 'food delivery'. You should focus only on 'category' column present in the table for creating the SQL query. Don't choose any other columns to create the SQL query.
@@ -50,50 +57,105 @@ def chatbot(user_input):
         Question:{question}
         Answer:"""
 
-        # Create the prompt template
-        prompt = PromptTemplate(template=template, input_variables=['question'])
+# Generated queries are cached per prompt and schema version
+SQL_PROMPT_VERSION = text_version(SQL_PROMPT_TEMPLATE, SCHEMA_VERSION)
+
 
-        # Initialize the LLM chain
-        llm_chain = LLMChain(prompt=prompt, llm=llm)
+NO_CONTENTS = "No contents to share at the moment"
 
-        # Generate the response
-        response = llm_chain.invoke(user_input)
 
-        # Ensure it's a string before processing
-        if isinstance(response["text"], str):
-            # Clean the generated SQL query
-            cleaned_sql_query = clean_sql_query(response["text"])
+# function to get the SQL for a question, from the cache or from the LLM
+@timed('ask', 'sql_generation')
+def generate_sql(question):
+    """
+    Returns:
+        tuple: The SQL query (None if the LLM gave no usable answer) and
+        whether it was generated rather than read from the cache.
+    """
+    cleaned_sql_query = sql_cache.get('expenses', question, SQL_PROMPT_VERSION)
+    if cleaned_sql_query is not None:
+        return cleaned_sql_query, False
+
+    # Generate the response
+    response = gateway.chat([{"role": "user", "content": SQL_PROMPT_TEMPLATE.format(question=question)}],
+                            model=CHAT_MODEL, temperature=0)
+
+    # Ensure it's a string before processing
+    if not isinstance(response, str):
+        #print("The response does not contain a valid SQL string.")
+        return None, True
+
+    # Clean the generated SQL query
+    return clean_sql_query(response), True
+
+
+# function to run the SQL of a question and return its result as text
+@timed('ask', 'sql_execution')
+def fetch_result(question, cleaned_sql_query, generated):
+    result = run_query(cleaned_sql_query)
+    if generated:
+        # The query ran, reuse it the next time the question is asked
+        sql_cache.put('expenses', question, SQL_PROMPT_VERSION, cleaned_sql_query)
+    if result:
+        return result
+    else :
+        return NO_CONTENTS
+
+
+def chatbot(user_input):
+    try:
+        question = user_input["question"]
+        cleaned_sql_query, generated = generate_sql(question)
+        if cleaned_sql_query is None:
+            return NO_CONTENTS
 
-            # Run the SQL query
-            if db.run(cleaned_sql_query):
-              result = db.run(cleaned_sql_query)
-              return result
-            else :
-              return "No contents to share at the moment"
-        else:
-            #print("The response does not contain a valid SQL string.")
-            return "No contents to share at the moment"
+        # Run the SQL query
+        return fetch_result(question, cleaned_sql_query, generated)
 
     except Exception as e:
         #print(f"Error: {e}")
-        return "No contents to share at the moment"
+        return NO_CONTENTS
     
 
-def generate_answer(question, result):
-    system_message = SystemMessage(content="You are an expense assistant and your name is SpendWise. Given the following user question and the corresponding SQL result, answer the user question based on the data present in SQL result and ignore what you are not provided with. If The result info appears to be an empty tuple, just say that the user has not made any expense. The currency used is AED. Ignore Total expenses from all categories. If user is asking any other questions, give tricky and intelligent responses")
-    human_message = HumanMessage(content=f"""
+ANSWER_SYSTEM_MESSAGE = "You are an expense assistant and your name is SpendWise. Given the following user question and the corresponding SQL result, answer the user question based on the data present in SQL result and ignore what you are not provided with. If The result info appears to be an empty tuple, just say that the user has not made any expense. The currency used is AED. Ignore Total expenses from all categories. If user is asking any other questions, give tricky and intelligent responses"
+
+
+def answer_messages(question, result):
+    return [
+        {"role": "system", "content": ANSWER_SYSTEM_MESSAGE},
+        {"role": "user", "content": f"""
     Question: {question}
     SQL Result: {result}
     Answer:
-    """)
+    """},
+    ]
 
-    response = llm.invoke([system_message, human_message])
 
+@timed('ask', 'answer_generation')
+def generate_answer(question, result):
+    response = gateway.chat(answer_messages(question, result), model=CHAT_MODEL, temperature=0)
+
+    return response
 
-    return response.content
+
+# function to answer the common questions from the database directly
+@timed('ask', 'intent')
+def local_answer(question):
+    try:
+        local = answer_locally(question, get_connection())
+        count('ask', 'intent', 'answered' if local is not None else 'missed', 1)
+        return local
+    except Exception as e:
+        logging.warning(f"Could not answer the question locally: {e}")
+        return None
 
 
 def run_chain(question):
+    # Common questions are answered without the LLM
+    local = local_answer(question)
+    if local is not None:
+        return local.text
+
     # Generate SQL query
     result = chatbot({"question": question})
 
@@ -101,4 +163,44 @@ def run_chain(question):
 
     final_answer = generate_answer(question, result)
 
-    return final_answer
\ No newline at end of file
+    return final_answer
+
+
+def stream_chain(question):
+    """
+    Answer a question step by step, for clients that show progress.
+
+    Yields:
+        tuple: (event, data) pairs: 'sql' once the query is known, 'rows'
+        once it ran, one 'token' per piece of the answer as the model
+        writes it, and 'done' with the full answer.
+    """
+    local = local_answer(question)
+    if local is not None:
+        yield 'sql', {'query': local.query, 'cached': True, 'intent': local.intent.name}
+        yield 'rows', {'result': str(local.rows)}
+        yield 'token', {'text': local.text}
+        yield 'done', {'response': local.text}
+        return
+
+    try:
+        cleaned_sql_query, generated = generate_sql(question)
+    except Exception as e:
+        logging.warning(f"Could not generate the SQL query: {e}")
+        cleaned_sql_query, generated = None, True
+    yield 'sql', {'query': cleaned_sql_query, 'cached': not generated}
+
+    result = NO_CONTENTS
+    if cleaned_sql_query is not None:
+        try:
+            result = fetch_result(question, cleaned_sql_query, generated)
+        except Exception as e:
+            logging.warning(f"Could not run the SQL query: {e}")
+    yield 'rows', {'result': result}
+
+    answer = []
+    with stage('ask', 'answer_generation'):
+        for token in gateway.stream_chat(answer_messages(question, result), model=CHAT_MODEL, temperature=0):
+            answer.append(token)
+            yield 'token', {'text': token}
+    yield 'done', {'response': ''.join(answer).strip()}
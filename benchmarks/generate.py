@@ -0,0 +1,132 @@
+import argparse
+import os
+import numpy as np
+import pandas as pd
+from src.location import UAE_CITIES
+
+# Merchants as they appear on statements, with the category the LLM gives them
+MERCHANTS = {
+    'NESTO HYPERMARKET LLC BRA': 'groceries',
+    'UNION COOP': 'groceries',
+    'LULU HYPERMARKET': 'groceries',
+    'CARREFOUR MOE': 'groceries',
+    'Talabat': 'food delivery',
+    'DELIVEROO': 'food delivery',
+    'BREW CAFE': 'restaurants and cafes',
+    'STARBUCKS MALL OF EMIRATES': 'restaurants and cafes',
+    'AL BAIK RESTAURANT': 'restaurants and cafes',
+    'CAREEM': 'transportation',
+    'RTA NOL TOPUP': 'transportation',
+    'ENOC 1043': 'transportation',
+    'Etisalat Digital App': 'phone and internet',
+    'DU TELECOM': 'phone and internet',
+    'Amazon.ae': 'e-commerce',
+    'NOON.COM': 'e-commerce',
+    'Swarovski': 'jewelry',
+    'MALABAR GOLD AND DIAMONDS': 'jewelry',
+    'AL AQSA GAR AND BLANKE': 'clothing',
+    'CENTREPOINT': 'clothing',
+    'ASTER PHARMACY': 'healthcare',
+    'FITNESS FIRST': 'fitness',
+    'GOOGLE CLOUD': 'others',
+    'DUBAI DUTY FREE': 'miscellaneous',
+}
+
+COLUMNS = ['Date', 'Description', 'Debits', 'Credits', 'Balance']
+
+
+def generate_statement(n_rows, transfer_fraction=0.05, n_merchants=None, seed=0):
+    """
+    Generate a synthetic statement table, like the one extracted from a PDF.
+
+    Card payments have 'CARD NO.' descriptions, the rest are 'IPI TT REF'
+    transfers that parse_transactions skips.
+
+    Args:
+        n_rows (int): The number of rows.
+        transfer_fraction (float): The fraction of transfer rows.
+        n_merchants (int): Number of distinct merchants. Beyond the known
+            merchants, branch numbers are appended to their names.
+        seed (int): Seed of the random generator.
+
+    Returns:
+        pd.DataFrame: The 'Date', 'Description', 'Debits', 'Credits' and
+        'Balance' columns, as text.
+    """
+    rng = np.random.default_rng(seed)
+    names = list(MERCHANTS)
+    if n_merchants is None:
+        n_merchants = len(names)
+    merchants = np.array([names[i % len(names)] + (f" {i // len(names)}" if i >= len(names) else '')
+                          for i in range(n_merchants)], dtype=object)
+
+    # Popular merchants get most of the transactions
+    weights = 1 / np.arange(1, n_merchants + 1)
+    merchant = merchants[rng.choice(n_merchants, n_rows, p=weights / weights.sum())]
+    city = np.array(UAE_CITIES, dtype=object)[rng.integers(0, len(UAE_CITIES), n_rows)]
+    amounts = np.round(rng.lognormal(3.5, 1.0, n_rows), 2)
+    transaction_dates = pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, 365, n_rows), unit='D')
+    posting_dates = transaction_dates + pd.to_timedelta(rng.integers(0, 4, n_rows), unit='D')
+    transaction_ids = rng.integers(0, 1000000, n_rows)
+
+    amount_text = pd.Series(amounts).map('{:.2f}'.format)
+    card = ('CARD NO.4439********1246 ' + pd.Series(merchant) + ' ' + pd.Series(city).str.upper() + ':AE ' +
+            pd.Series(transaction_ids).map('{:06d}'.format) + ' ' +
+            pd.Series(transaction_dates.strftime('%d-%m-%Y')) + ' ' + amount_text + ',AED')
+    transfer = 'IPI TT REF: ' + pd.Series(rng.integers(0, 10 ** 9, n_rows)).map('{:09d}'.format) + ' SALARY TRANSFER'
+    is_transfer = rng.random(n_rows) < transfer_fraction
+
+    balance = np.round(50000 - np.cumsum(np.where(is_transfer, -amounts * 20, amounts)), 2)
+    return pd.DataFrame({
+        'Date': posting_dates.strftime('%d %b %Y'),
+        'Description': np.where(is_transfer, transfer, card),
+        'Debits': np.where(is_transfer, '', amount_text),
+        'Credits': np.where(is_transfer, pd.Series(amounts * 20).map('{:.2f}'.format), ''),
+        'Balance': pd.Series(balance).map('{:.2f}'.format),
+    })
+
+
+def write_statement_pdf(df, pdf_path, rows_per_page=30):
+    """
+    Write a statement table as a multi-page PDF, one table per page, that
+    extract_table_from_pdf can read back.
+
+    Needs reportlab (see requirements-dev.txt).
+    """
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import A4, landscape
+    from reportlab.platypus import PageBreak, SimpleDocTemplate, Table, TableStyle
+
+    style = TableStyle([('GRID', (0, 0), (-1, -1), 0.5, colors.black), ('FONTSIZE', (0, 0), (-1, -1), 6)])
+    elements = []
+    rows = df[COLUMNS].values.tolist()
+    for start in range(0, len(rows), rows_per_page):
+        # Repeat the header if a page table overflows onto the next page
+        table = Table([COLUMNS] + rows[start:start + rows_per_page], repeatRows=1)
+        table.setStyle(style)
+        elements += [table, PageBreak()]
+    SimpleDocTemplate(pdf_path, pagesize=landscape(A4)).build(elements)
+    return pdf_path
+
+
+# Example usage:
+#   python -m benchmarks.generate --rows 1000 --pdf data/synthetic_statement.pdf
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic bank statement")
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--merchants', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--csv', help="Write the statement table to this CSV file")
+    parser.add_argument('--pdf', help="Write the statement to this PDF file")
+    args = parser.parse_args()
+
+    statement = generate_statement(args.rows, n_merchants=args.merchants, seed=args.seed)
+    for path in (args.csv, args.pdf):
+        if path and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+    if args.csv:
+        statement.to_csv(args.csv, index=False)
+    if args.pdf:
+        write_statement_pdf(statement, args.pdf)
+    if not (args.csv or args.pdf):
+        print(statement.head(10).to_markdown(index=False))
@@ -0,0 +1,172 @@
+import argparse
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from benchmarks.generate import generate_statement, write_statement_pdf
+
+# A mix of questions answered locally and questions that need the LLM
+QUESTIONS = [
+    "How much did I spend in total?",
+    "How much did I spend on food?",
+    "breakdown my expenditure by category",
+    "What was my biggest purchase?",
+    "How much did I spend at careem?",
+    "Which merchant do I visit the most?",
+    "Compare my spending on groceries and food delivery",
+]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return None
+    index = min(int(round(fraction * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def summarize(latencies, errors, elapsed):
+    return {
+        'requests': len(latencies) + errors,
+        'errors': errors,
+        'throughput': len(latencies) / elapsed if elapsed else None,
+        'p50': percentile(latencies, 0.50),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+    }
+
+
+class LoadTest:
+    """
+    Drives concurrent questions and uploads against a running app.py, and
+    records the latency of each (for uploads, until their job is done).
+    """
+
+    def __init__(self, base_url, token, statements=(), upload_fraction=0.1, job_timeout=600):
+        self.base_url = base_url.rstrip('/')
+        self.headers = {'x-token': token}
+        self.statements = list(statements)
+        self.upload_fraction = upload_fraction if self.statements else 0.0
+        self.job_timeout = job_timeout
+        self.latencies = {'ask': [], 'upload': []}
+        self.errors = {'ask': 0, 'upload': 0}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def _record(self, operation, start, ok):
+        with self._lock:
+            if ok:
+                self.latencies[operation].append(time.perf_counter() - start)
+            else:
+                self.errors[operation] += 1
+
+    def ask(self):
+        start = time.perf_counter()
+        try:
+            response = self._session().post(f"{self.base_url}/ask/", headers=self.headers,
+                                            json={'question': random.choice(QUESTIONS)}, timeout=300)
+            ok = response.status_code == 200
+        except requests.RequestException:
+            ok = False
+        self._record('ask', start, ok)
+
+    def upload(self):
+        start = time.perf_counter()
+        ok = False
+        try:
+            with open(random.choice(self.statements), 'rb') as f:
+                response = self._session().post(f"{self.base_url}/upload_pdf/", headers=self.headers,
+                                                files={'file': ('statement.pdf', f, 'application/pdf')},
+                                                timeout=300)
+            if response.status_code == 200:
+                status_url = f"{self.base_url}{response.json()['status_url']}"
+                while time.perf_counter() - start < self.job_timeout:
+                    job = self._session().get(status_url, headers=self.headers, timeout=30).json()
+                    if job['status'] in ('done', 'failed'):
+                        ok = job['status'] == 'done'
+                        break
+                    time.sleep(0.2)
+        except requests.RequestException:
+            ok = False
+        self._record('upload', start, ok)
+
+    def _client(self, deadline, remaining):
+        while time.perf_counter() < deadline:
+            with self._lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            if random.random() < self.upload_fraction:
+                self.upload()
+            else:
+                self.ask()
+
+    def run(self, concurrency, requests_count=None, duration=None):
+        """
+        Run `concurrency` clients until `requests_count` requests were sent or
+        `duration` seconds passed.
+
+        Returns:
+            dict: The throughput (requests/s) and p50/p95/p99 latencies (s) of
+            each operation.
+        """
+        start = time.perf_counter()
+        deadline = start + duration if duration else float('inf')
+        remaining = [requests_count if requests_count else float('inf')]
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for _ in range(concurrency):
+                executor.submit(self._client, deadline, remaining)
+        elapsed = time.perf_counter() - start
+        return {
+            'concurrency': concurrency,
+            'elapsed': elapsed,
+            'ask': summarize(self.latencies['ask'], self.errors['ask'], elapsed),
+            'upload': summarize(self.latencies['upload'], self.errors['upload'], elapsed),
+        }
+
+
+# Example usage (with benchmarks/mock_ai71.py standing in for the API):
+#   python -m benchmarks.load --url http://localhost:8000 --concurrency 16 --requests 500 --uploads 0.05
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the SpendWise API")
+    parser.add_argument('--url', default='http://localhost:8000')
+    parser.add_argument('--token', default=os.getenv('SPENDWISE_TOKEN', ''))
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=200, help="Total requests to send")
+    parser.add_argument('--duration', type=float, help="Stop after this many seconds")
+    parser.add_argument('--uploads', type=float, default=0.1, help="Fraction of requests that upload a statement")
+    parser.add_argument('--statement-rows', type=int, default=300)
+    parser.add_argument('--statements', type=int, default=4, help="Distinct statements to upload")
+    parser.add_argument('--output', help="Save the results to this JSON file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        statements = []
+        if args.uploads > 0:
+            for seed in range(args.statements):
+                statements.append(write_statement_pdf(generate_statement(args.statement_rows, seed=seed),
+                                                      os.path.join(directory, f"statement_{seed}.pdf")))
+        test = LoadTest(args.url, args.token, statements, upload_fraction=args.uploads)
+        results = test.run(args.concurrency, requests_count=args.requests, duration=args.duration)
+
+    for operation in ('ask', 'upload'):
+        summary = results[operation]
+        if summary['requests'] and summary['p50'] is None:
+            print(f"{operation:>6}: {summary['requests']} requests, all failed")
+        elif summary['requests']:
+            print(f"{operation:>6}: {summary['requests']} requests, {summary['errors']} errors, "
+                  f"{summary['throughput']:.2f}/s, p50 {summary['p50']:.3f}s, p95 {summary['p95']:.3f}s, "
+                  f"p99 {summary['p99']:.3f}s")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,114 @@
+import argparse
+import asyncio
+import json
+import random
+import re
+import time
+import uuid
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+import uvicorn
+from src.classifier import LocalClassifier
+
+# Behaviour of the stand-in, set from the command line
+settings = {
+    'latency': 0.5,  # seconds before the answer (or the first token)
+    'jitter': 0.2,  # extra random latency, up to this many seconds
+    'token_latency': 0.02,  # seconds between streamed tokens
+    'rate_limit': 0.0,  # fraction of requests answered with 429
+    'retry_after': 1.0,  # Retry-After of the 429 answers, in seconds
+}
+
+CANNED_SQL = {
+    # SQL_PROMPT_TEMPLATE of apps/run_chain.py, on the expenses database
+    'expenses': 'SELECT "Category", SUM("Amount") FROM expenses GROUP BY "Category" ORDER BY SUM("Amount") DESC;',
+    # get_sql_query of src/data.py, on the bot's DataFrame
+    'df': 'SELECT Category, SUM(Amount) AS Total FROM df GROUP BY Category ORDER BY Total DESC',
+}
+CANNED_ANSWER = ("Here is what I found in your expenses: most of your spending went to groceries, "
+                 "followed by food delivery and transportation. All amounts are in AED.")
+
+classifier = LocalClassifier()
+stats = {'requests': 0, 'rate_limited': 0}
+
+app = FastAPI()
+
+
+def answer_for(messages):
+    """Pick a canned answer looking like the one the real model gives to this prompt."""
+    system = ' '.join(m.get('content', '') for m in messages if m.get('role') == 'system')
+    user = ' '.join(m.get('content', '') for m in messages if m.get('role') == 'user')
+    if 'classify them' in system:
+        # classify_company: a JSON object of company name -> category
+        names = [name.strip() for name in user.split(',') if name.strip()]
+        return json.dumps({name: classifier.predict(name)[0] or 'others' for name in names})
+    if 'SQL database named' in user:
+        return CANNED_SQL['expenses']
+    if 'write queries' in system:
+        return CANNED_SQL['df']
+    return CANNED_ANSWER
+
+
+async def wait():
+    await asyncio.sleep(settings['latency'] + random.random() * settings['jitter'])
+
+
+def completion(model, content):
+    return {
+        'id': f"chatcmpl-{uuid.uuid4().hex}",
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': model,
+        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+    }
+
+
+async def stream(model, content):
+    await wait()
+    for token in re.findall(r'\S+\s*', content):
+        chunk = {'object': 'chat.completion.chunk', 'model': model,
+                 'choices': [{'index': 0, 'delta': {'content': token}, 'finish_reason': None}]}
+        yield f"data: {json.dumps(chunk)}\n\n"
+        await asyncio.sleep(settings['token_latency'])
+    yield "data: [DONE]\n\n"
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    payload = await request.json()
+    stats['requests'] += 1
+    if random.random() < settings['rate_limit']:
+        stats['rate_limited'] += 1
+        return JSONResponse(status_code=429, headers={'Retry-After': str(settings['retry_after'])},
+                            content={'error': 'rate limit exceeded', 'retry_after': settings['retry_after']})
+
+    model = payload.get('model', 'tiiuae/falcon-180b-chat')
+    content = answer_for(payload.get('messages', []))
+    if payload.get('stream'):
+        return StreamingResponse(stream(model, content), media_type='text/event-stream')
+    await wait()
+    return JSONResponse(content=completion(model, content))
+
+
+@app.get("/stats")
+def get_stats():
+    return stats
+
+
+# Example usage:
+#   python -m benchmarks.mock_ai71 --port 8001 --latency 0.5 --rate-limit 0.05
+#   AI71_BASE_URL=http://localhost:8001/v1/ uvicorn app:app --port 8000
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the AI71 chat completions API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--latency', type=float, default=settings['latency'])
+    parser.add_argument('--jitter', type=float, default=settings['jitter'])
+    parser.add_argument('--token-latency', type=float, default=settings['token_latency'])
+    parser.add_argument('--rate-limit', type=float, default=settings['rate_limit'],
+                        help="Fraction of requests answered with 429")
+    parser.add_argument('--retry-after', type=float, default=settings['retry_after'])
+    args = parser.parse_args()
+    settings.update(latency=args.latency, jitter=args.jitter, token_latency=args.token_latency,
+                    rate_limit=args.rate_limit, retry_after=args.retry_after)
+    uvicorn.run(app, host=args.host, port=args.port, log_level='warning')
@@ -0,0 +1,141 @@
+import argparse
+import json
+import os
+import platform
+import re
+import statistics
+import subprocess
+import tempfile
+import time
+import pandas as pd
+from benchmarks.generate import MERCHANTS, generate_statement, write_statement_pdf
+from src.data import (PDF_WORKERS, bytes_per_row, canonicalize_merchants, categorize_transactions,
+                      extract_table_from_pdf, parse_transactions)
+from src.merchants import MerchantCanonicalizer, normalize_merchant
+from src.report import generate_bank_statement_report
+from src.storage import read_table
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def timed(func, repeat):
+    """Run `func` `repeat` times, returning its last result and the timings in seconds."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return result, timings
+
+
+def category_map_for(merchants):
+    # The categories the LLM would give, without calling it
+    known = {normalize_merchant(name): category for name, category in MERCHANTS.items()}
+    # Branch numbers of the generated merchants are kept by the canonicalization
+    return {merchant: known.get(merchant, known.get(re.sub(r' \d+$', '', merchant), 'others'))
+            for merchant in merchants}
+
+
+def canonicalizer():
+    # A new one for each run, so every run pays for the matching
+    return MerchantCanonicalizer(known=lambda: MERCHANTS)
+
+
+def no_llm(user_content):
+    raise RuntimeError("The benchmark must not call the LLM")
+
+
+def run_size(n_rows, repeat, pdf_max_rows, workers, seed=0):
+    """Time every stage of the pipeline on a synthetic statement of `n_rows` rows."""
+    results = []
+
+    def record(stage, timings, **extra):
+        best = min(timings)
+        results.append({'stage': stage, 'rows': n_rows, 'seconds_min': best,
+                        'seconds_median': statistics.median(timings),
+                        'rows_per_second': n_rows / best if best else None, **extra})
+        print(f"{stage:>12} {n_rows:>9} rows  {best:9.4f}s")
+
+    statement = generate_statement(n_rows, seed=seed)
+
+    if n_rows <= pdf_max_rows:
+        with tempfile.TemporaryDirectory() as directory:
+            pdf_path = write_statement_pdf(statement, os.path.join(directory, 'statement.pdf'))
+            table_path, timings = timed(lambda: extract_table_from_pdf(pdf_path, workers=workers), repeat)
+            extracted = len(read_table(table_path)) if table_path else 0
+            record('extract', timings, workers=workers, rows_extracted=extracted)
+    else:
+        print(f"{'extract':>12} {n_rows:>9} rows  skipped (over --pdf-max-rows)")
+
+    parsed, timings = timed(lambda: parse_transactions(statement), repeat)
+    record('parse', timings, transactions=len(parsed), bytes_per_row=bytes_per_row(parsed))
+
+    keys, timings = timed(lambda: canonicalize_merchants(parsed['Merchant'], canonicalizer()), repeat)
+    record('canonicalize', timings, spellings=parsed['Merchant'].nunique(), merchants=keys.nunique())
+
+    category_map = category_map_for(keys.unique())
+    categorized, timings = timed(lambda: categorize_transactions(parsed.copy(), no_llm, dict(category_map),
+                                                                 cache=None, local=None,
+                                                                 canonicalizer=canonicalizer()), repeat)
+    record('categorize', timings)
+
+    _, timings = timed(lambda: generate_bank_statement_report(categorized.copy(), markdown=False), repeat)
+    record('report', timings)
+    return results
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {(r['stage'], r['rows']): r for r in json.load(f)['results']}
+    print(f"\nCompared with {baseline_path}:")
+    for result in results:
+        before = baseline.get((result['stage'], result['rows']))
+        if before:
+            ratio = before['seconds_min'] / result['seconds_min'] if result['seconds_min'] else float('inf')
+            print(f"{result['stage']:>12} {result['rows']:>9} rows  {ratio:6.2f}x")
+
+
+# Example usage:
+#   python -m benchmarks.run --sizes 1000,100000 --compare benchmarks/results/<commit>.json
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the SpendWise pipeline on synthetic statements")
+    parser.add_argument('--sizes', default='1000,100000,1000000', help="Comma separated row counts")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--pdf-max-rows', type=int, default=10000,
+                        help="Largest statement rendered as a PDF to time the extraction")
+    parser.add_argument('--workers', type=int, default=PDF_WORKERS)
+    parser.add_argument('--output', help="JSON file for the results (default: benchmarks/results/<commit>.json)")
+    parser.add_argument('--compare', help="JSON results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes.split(','):
+        results += run_size(int(size), args.repeat, args.pdf_max_rows, args.workers)
+
+    commit = git_commit()
+    report = {
+        'commit': commit,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'results': results,
+    }
+    output = args.output or os.path.join(RESULTS_DIR, f"{commit[:12]}.json")
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults saved to {output}")
+
+    if args.compare:
+        compare(results, args.compare)
@@ -1,14 +1,29 @@
+import asyncio
 import discord
+import functools
 import os
 import pdfplumber
-import pandas as pd
-import json
-from src.data import extract_table_from_pdf, parse_transactions, classify_company, execute_query_and_display, format_table_as_text
+from src.data import extract_table_from_pdf, PDF_WORKERS, statement_key, parse_transactions, classify_company, categorize_transactions, execute_query_and_display
 from src.report import generate_bank_statement_report
+from src.cache import statement_cache
+from src.storage import write_table, read_table
+from src.query import query_engine
 from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor
 import random
 load_dotenv()
 
+# Threads running the blocking stages (PDF extraction, LLM calls, queries) off the event loop.
+# Questions get their own threads, so they are answered while statements are being ingested.
+INGEST_WORKERS = int(os.getenv('SPENDWISE_BOT_INGEST_WORKERS', 4))
+ASK_WORKERS = int(os.getenv('SPENDWISE_BOT_ASK_WORKERS', 4))
+# Statements ingested at the same time per server, the next ones wait for their turn
+GUILD_INGESTS = int(os.getenv('SPENDWISE_BOT_GUILD_INGESTS', 1))
+
+ingest_executor = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix='ingest')
+ask_executor = ThreadPoolExecutor(max_workers=ASK_WORKERS, thread_name_prefix='ask')
+guild_ingests = {}
+
 # Replace 'YOUR_BOT_TOKEN' with your actual bot token
 TOKEN = os.getenv('DISCORD_BOT_TOKEN')
 
@@ -18,75 +33,97 @@ intents.message_content = True
 client = discord.Client(intents=intents)
 
 
+# function to run a blocking call in an executor, without blocking the event loop
+async def run_blocking(executor, func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+
+# function to get the semaphore limiting the concurrent ingests of a server (or DM channel)
+def ingest_limit(message):
+    key = message.guild.id if message.guild is not None else message.channel.id
+    if key not in guild_ingests:
+        guild_ingests[key] = asyncio.Semaphore(GUILD_INGESTS)
+    return guild_ingests[key]
+
+
+# function to extract, parse and categorize a statement, and report on it
+async def ingest_statement(message, attachment, df_file_path):
+    await message.channel.send('"PDF received! Extracting content now...')
+    pdf_path = f"./data/bank_statement_{message.id}.pdf"
+    await attachment.save(pdf_path)
+    try:
+        key = await run_blocking(ingest_executor, statement_key, pdf_path)
+        df = await run_blocking(ingest_executor, statement_cache.get, key)
+        if df is not None:
+            await message.channel.send('We have seen this statement before, reusing its extracted transactions.')
+        else:
+            table_path = await run_blocking(ingest_executor, extract_table_from_pdf, pdf_path, workers=PDF_WORKERS)
+            if not table_path:
+                await message.channel.send('Failed to extract tables from the PDF.')
+                return
+            await message.channel.send('Successfully extracted the content of the PDF.')
+
+            df = await run_blocking(ingest_executor, read_table, table_path)
+            table_str = df[['Description']].head().to_markdown(index=False) #TODO check if column name exists
+            await message.channel.send('\nHere is a sample of the transactions:\n')
+            await message.channel.send(f'```\n{table_str}\n```')
+
+            await message.channel.send('Identifying key details from transactions...\n')
+            df = await run_blocking(ingest_executor, parse_transactions, df)
+            await run_blocking(ingest_executor, statement_cache.put, key, df)
+    finally:
+        # The statement and the tables extracted from it are not kept
+        for path in (pdf_path, os.path.splitext(pdf_path)[0] + '.parquet'):
+            if os.path.exists(path):
+                os.remove(path)
+    table_str = df.head().to_markdown(index=False)
+    await message.channel.send(f'```\n{table_str}\n```')
+
+    await message.channel.send('Hang tight! We are categorizing your transaction into the right spending category. This will just take a moment.\n')
+    cols = df.columns.to_list()
+    df = await run_blocking(ingest_executor, categorize_transactions, df, classify_company)
+    cols += ['Category']
+    table_str = df.filter(cols).head().to_markdown(index=False)  # Use markdown for better formatting
+    await message.channel.send(f'```\n{table_str}\n```')
+
+    df_filtered = df[cols]
+    await run_blocking(ingest_executor, write_table, df_filtered, df_file_path)
+    # Questions are answered from memory, the file is only read back after a restart.
+    # Registering copies the frame and waits for running queries, so it is off the loop too.
+    await run_blocking(ingest_executor, query_engine.register, df_filtered)
+    await run_blocking(ingest_executor, query_engine.mark_file, df_file_path)
+
+    await message.channel.send('Creating your Bank Statement Analytics Report...\n')
+    md_report = await run_blocking(ingest_executor, generate_bank_statement_report, df)
+    await message.channel.send(md_report)
+    await message.channel.send("-# To run queries on the data, type /ask followed by your question. E.g., '/ask What is my biggest purchase?'")
+
+
+# function to answer a question about the last ingested statement
+def answer_question(question, df_file_path):
+    query_engine.register_file(df_file_path)
+    return execute_query_and_display(question)
+
+
 @client.event
 async def on_ready():
     print(f'We have logged in as {client.user}')
 
 @client.event
 async def on_message(message):
-    df_file_path = 'filtered_data.csv'
+    df_file_path = 'filtered_data.parquet'
 
     if message.attachments:
         for attachment in message.attachments:
             if attachment.filename.endswith('.pdf'):
-                await message.channel.send('"PDF received! Extracting content now...')
-                pdf_path = "./data/bank_statement.pdf"
-                await attachment.save(pdf_path)
-
-                csv_path = extract_table_from_pdf(pdf_path)
-                if csv_path:
-                    await message.channel.send('Successfully extracted the content of the PDF.')
-                else:
-                    await message.channel.send('Failed to extract tables from the PDF.')
-                
-                df = pd.read_csv(csv_path)
-                table_str = df[['Description']].head().to_markdown(index=False) #TODO check if column name exists
-                await message.channel.send('\nHere is a sample of the transactions:\n')
-                await message.channel.send(f'```\n{table_str}\n```')
-
-                await message.channel.send('Identifying key details from transactions...\n')
-                df = parse_transactions(df)
-                table_str = df.head().to_markdown(index=False)
-                await message.channel.send(f'```\n{table_str}\n```')
-                
-                await message.channel.send('Hang tight! We are categorizing your transaction into the right spending category. This will just take a moment.\n')
-                cols = df.columns.to_list()
-                merchants = df.Merchant.drop_duplicates()
-                merchants_str = ', '.join(merchants)
-                results = classify_company(merchants_str)
-                category_map = json.loads(results)
-                df['Category_freetext'] = df['Merchant'].map(category_map)#TODO cache
-                categories = ['fitness', 'groceries', 'restaurants and cafes', 'healthcare', 'clothing', 'jewelry',
-                              'transportation', 'phone and internet', 'miscellaneous', 'others', 'e-commerce', 'food delivery']
-
-                def find_first_match(text, categories ):
-                    for category in categories :
-                        if category in text.lower():
-                            return category
-                    return None
-                # Strip leading/trailing spaces and convert to lowercase
-                df['Merchant'] = df['Merchant'].str.strip().str.lower()
-
-                # Update category_map to match the cleaned Merchant values if needed
-                category_map = {k.lower(): v for k, v in category_map.items()}
-
-                # Apply the mapping again
-                df['Category_freetext'] = df['Merchant'].map(category_map)
-
-                df['Category'] = df['Category_freetext'].apply(lambda x: find_first_match(x, categories))
-                cols += ['Category']
-                table_str = df.filter(cols).head().to_markdown(index=False)  # Use markdown for better formatting
-                await message.channel.send(f'```\n{table_str}\n```')
-
-                df_filtered = df[cols]
-                df_filtered.to_csv(df_file_path, index=False)
-
-                await message.channel.send('Creating your Bank Statement Analytics Report...\n')
-                md_report = generate_bank_statement_report(df)
-                await message.channel.send(md_report)
-                await message.channel.send("-# To run queries on the data, type /ask followed by your question. E.g., '/ask What is my biggest purchase?'")
-    
-                
+                limit = ingest_limit(message)
+                if limit.locked():
+                    await message.channel.send('Another statement is being processed, yours is next in line.')
+                async with limit:
+                    await ingest_statement(message, attachment, df_file_path)
+
+
     if message.content.startswith('/ask'):
         messages = [
             "Hang tight, we're working on it!",
@@ -102,8 +139,7 @@ async def on_message(message):
         await message.channel.send(response_message)
         if os.path.exists(df_file_path):
             try:
-                df = pd.read_csv(df_file_path)
-                markdown_content = execute_query_and_display(message.content, df)
+                markdown_content = await run_blocking(ask_executor, answer_question, message.content, df_file_path)
                 await message.channel.send(markdown_content)
             except Exception as e:
                 await message.channel.send(f'Error processing the query')
@@ -116,5 +152,7 @@ async def on_message(message):
 
 
 
-# Run the bot
-client.run(TOKEN)
+# Run the bot. Only when run as a script: the PDF extraction workers are spawned
+# processes, which import this module again.
+if __name__ == "__main__":
+    client.run(TOKEN)
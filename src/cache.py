@@ -0,0 +1,348 @@
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from src.storage import write_table, read_table
+
+STATEMENT_CACHE_DIR = os.getenv('SPENDWISE_STATEMENT_CACHE_DIR', 'data/cache/statements')
+STATEMENT_CACHE_MAX_BYTES = int(os.getenv('SPENDWISE_STATEMENT_CACHE_MAX_BYTES', 100 * 1024 * 1024))
+
+MERCHANT_CACHE_PATH = os.getenv('SPENDWISE_MERCHANT_CACHE', 'data/cache/merchant_categories.db')
+MERCHANT_CACHE_TTL = int(os.getenv('SPENDWISE_MERCHANT_CACHE_TTL', 90 * 24 * 3600))
+MERCHANT_CACHE_MAX_ENTRIES = int(os.getenv('SPENDWISE_MERCHANT_CACHE_MAX_ENTRIES', 100000))
+
+SQL_CACHE_PATH = os.getenv('SPENDWISE_SQL_CACHE', 'data/cache/sql_queries.db')
+SQL_CACHE_MAX_ENTRIES = int(os.getenv('SPENDWISE_SQL_CACHE_MAX_ENTRIES', 10000))
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """
+    Compute the SHA-256 hex digest of a file's content.
+
+    Args:
+        path (str): The path to the file.
+
+    Returns:
+        str: The hex digest.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class StatementCache:
+    """
+    On-disk cache of parsed statements, keyed by the hash of the PDF bytes.
+
+    Entries are stored as Parquet files, which keep the dtypes of the
+    columns and are memory-mapped when read. When the total size goes over
+    `max_bytes`, the least recently used entries are evicted.
+    """
+
+    def __init__(self, cache_dir=STATEMENT_CACHE_DIR, max_bytes=STATEMENT_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.parquet")
+
+    def get(self, key):
+        """Return the cached DataFrame for `key`, or None on a miss."""
+        path = self._path(key)
+        try:
+            df = read_table(path)
+            # Mark the entry as recently used for the LRU eviction
+            os.utime(path)
+        except FileNotFoundError:
+            df = None
+        except Exception as e:
+            logging.warning(f"Dropping unreadable cache entry '{path}': {e}")
+            self._remove(path)
+            df = None
+
+        with self._lock:
+            if df is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return df
+
+    def put(self, key, df):
+        """Store `df` under `key`, evicting old entries if the cache is full."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        write_table(df, self._path(key))
+        self._evict()
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _entries(self):
+        entries = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                # Pickles of older versions are evicted like any other entry
+                if entry.name.endswith(('.parquet', '.pkl.gz')):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def _evict(self):
+        with self._lock:
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                self._remove(path)
+                total -= size
+
+    def stats(self):
+        """Return the hit/miss counters and the current size of the cache."""
+        entries = self._entries() if os.path.isdir(self.cache_dir) else []
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(entries),
+            'bytes': sum(size for _, size, _ in entries),
+        }
+
+
+class MerchantCategoryCache:
+    """
+    Persistent merchant -> category store, kept in a SQLite database.
+
+    Entries classified by the LLM expire after `ttl` seconds, and the least
+    recently used ones are evicted beyond `max_entries`. Pinned entries are
+    manual overrides: they never expire and are not replaced by the LLM.
+    """
+
+    def __init__(self, path=MERCHANT_CACHE_PATH, ttl=MERCHANT_CACHE_TTL, max_entries=MERCHANT_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS merchant_categories (
+                merchant TEXT PRIMARY KEY,
+                category TEXT NOT NULL,
+                pinned INTEGER NOT NULL DEFAULT 0,
+                updated_at REAL NOT NULL,
+                used_at REAL NOT NULL
+            )""")
+        return conn
+
+    def get_many(self, merchants):
+        """
+        Look up the categories of `merchants`.
+
+        Returns:
+            dict: merchant -> category for the merchants found in the cache.
+        """
+        merchants = list(merchants)
+        now = time.time()
+        found = {}
+        conn = self._connect()
+        try:
+            # Stay below SQLite's limit on the number of query parameters
+            for i in range(0, len(merchants), 500):
+                chunk = merchants[i:i + 500]
+                placeholders = ', '.join('?' * len(chunk))
+                rows = conn.execute(
+                    f"SELECT merchant, category FROM merchant_categories "
+                    f"WHERE merchant IN ({placeholders}) AND (pinned = 1 OR updated_at >= ?)",
+                    chunk + [now - self.ttl])
+                found.update(rows)
+            conn.executemany("UPDATE merchant_categories SET used_at = ? WHERE merchant = ?",
+                             [(now, merchant) for merchant in found])
+            conn.commit()
+        finally:
+            conn.close()
+
+        with self._lock:
+            self.hits += len(found)
+            self.misses += len(merchants) - len(found)
+        return found
+
+    def put_many(self, categories):
+        """Store merchant -> category results, leaving pinned entries untouched."""
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.executemany("""
+                INSERT INTO merchant_categories (merchant, category, pinned, updated_at, used_at)
+                VALUES (?, ?, 0, ?, ?)
+                ON CONFLICT(merchant) DO UPDATE SET
+                    category = excluded.category, updated_at = excluded.updated_at, used_at = excluded.used_at
+                WHERE pinned = 0""",
+                [(merchant, category, now, now) for merchant, category in categories.items()])
+            self._evict(conn, now)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def items(self):
+        """Return all the unexpired (merchant, category) pairs of the store."""
+        conn = self._connect()
+        try:
+            return conn.execute(
+                "SELECT merchant, category FROM merchant_categories WHERE pinned = 1 OR updated_at >= ?",
+                (time.time() - self.ttl,)).fetchall()
+        finally:
+            conn.close()
+
+    def pin(self, merchant, category):
+        """Set a manual category override for a merchant."""
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("INSERT OR REPLACE INTO merchant_categories VALUES (?, ?, 1, ?, ?)",
+                         (merchant, category, now, now))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def unpin(self, merchant):
+        """Remove the override of a merchant, so it is classified again."""
+        conn = self._connect()
+        try:
+            conn.execute("DELETE FROM merchant_categories WHERE merchant = ? AND pinned = 1", (merchant,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _evict(self, conn, now):
+        conn.execute("DELETE FROM merchant_categories WHERE pinned = 0 AND updated_at < ?", (now - self.ttl,))
+        conn.execute("""
+            DELETE FROM merchant_categories WHERE merchant IN (
+                SELECT merchant FROM merchant_categories WHERE pinned = 0
+                ORDER BY used_at DESC LIMIT -1 OFFSET ?)""", (self.max_entries,))
+
+    def stats(self):
+        """Return the hit/miss counters (in merchants) of this process."""
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+def normalize_question(question):
+    """Lowercase a question and drop punctuation and repeated whitespace."""
+    return ' '.join(re.sub(r'[^\w\s-]', ' ', question.lower()).split())
+
+
+def text_version(*parts):
+    """Short hash of prompt templates and schema versions, used as a cache version."""
+    return hashlib.sha256('\x00'.join(str(part) for part in parts).encode('utf-8')).hexdigest()[:16]
+
+
+class SQLQueryCache:
+    """
+    Persistent cache of the SQL generated for natural language questions.
+
+    Entries are keyed by a namespace (the call site), the normalised question
+    and a version hashed from the prompt template and the schema. Changing
+    the template changes the version: the old entries of the namespace are no
+    longer returned and are purged on the next write. The least recently used
+    entries are evicted beyond `max_entries`.
+    """
+
+    def __init__(self, path=SQL_CACHE_PATH, max_entries=SQL_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS sql_queries (
+                namespace TEXT NOT NULL,
+                question TEXT NOT NULL,
+                version TEXT NOT NULL,
+                query TEXT NOT NULL,
+                used_at REAL NOT NULL,
+                PRIMARY KEY (namespace, question)
+            )""")
+        return conn
+
+    def get(self, namespace, question, version):
+        """Return the cached SQL for a question, or None on a miss."""
+        question = normalize_question(question)
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT query FROM sql_queries WHERE namespace = ? AND question = ? AND version = ?",
+                               (namespace, question, version)).fetchone()
+            if row is not None:
+                conn.execute("UPDATE sql_queries SET used_at = ? WHERE namespace = ? AND question = ?",
+                             (time.time(), namespace, question))
+                conn.commit()
+        finally:
+            conn.close()
+
+        with self._lock:
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return row[0] if row is not None else None
+
+    def put(self, namespace, question, version, query):
+        """Store the SQL generated for a question."""
+        question = normalize_question(question)
+        conn = self._connect()
+        try:
+            # Entries generated from another prompt template are stale
+            conn.execute("DELETE FROM sql_queries WHERE namespace = ? AND version != ?", (namespace, version))
+            conn.execute("INSERT OR REPLACE INTO sql_queries VALUES (?, ?, ?, ?, ?)",
+                         (namespace, question, version, query, time.time()))
+            conn.execute("""
+                DELETE FROM sql_queries WHERE rowid IN (
+                    SELECT rowid FROM sql_queries ORDER BY used_at DESC LIMIT -1 OFFSET ?)""",
+                         (self.max_entries,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def stats(self):
+        """Return the hit/miss counters of this process."""
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+statement_cache = StatementCache()
+merchant_cache = MerchantCategoryCache()
+sql_cache = SQLQueryCache()
+
+
+# Example usage (manual overrides):
+#   python -m src.cache pin "nesto hypermarket llc bra" groceries
+#   python -m src.cache unpin "nesto hypermarket llc bra"
+if __name__ == "__main__":
+    import sys
+    # Merchants are cached by canonical key (see src/merchants.py)
+    from src.merchants import merchant_canonicalizer
+    if len(sys.argv) == 4 and sys.argv[1] == 'pin':
+        merchant_cache.pin(merchant_canonicalizer.canonical(sys.argv[2]), sys.argv[3])
+    elif len(sys.argv) == 3 and sys.argv[1] == 'unpin':
+        merchant_cache.unpin(merchant_canonicalizer.canonical(sys.argv[2]))
+    else:
+        print("usage: python -m src.cache pin <merchant> <category> | unpin <merchant>")
@@ -0,0 +1,205 @@
+import logging
+import math
+import os
+import re
+import threading
+from collections import Counter, defaultdict
+from src.cache import merchant_cache
+
+CATEGORIES = ['fitness', 'groceries', 'restaurants and cafes', 'healthcare', 'clothing', 'jewelry',
+              'transportation', 'phone and internet', 'miscellaneous', 'others', 'e-commerce', 'food delivery']
+
+# Minimum confidence for a local prediction to be used instead of the LLM
+LOCAL_CONFIDENCE = float(os.getenv('SPENDWISE_LOCAL_CONFIDENCE', 0.8))
+
+# Words that identify the category of a merchant on their own
+CATEGORY_KEYWORDS = {
+    'fitness': ['gym', 'gyms', 'fitness', 'yoga', 'pilates', 'crossfit', 'sports club'],
+    'groceries': ['hypermarket', 'supermarket', 'grocery', 'grocer', 'groceries', 'baqala', 'carrefour',
+                  'lulu', 'nesto', 'spinneys', 'waitrose', 'choithrams', 'union coop', 'viva', 'geant'],
+    'restaurants and cafes': ['restaurant', 'restaurants', 'cafe', 'cafeteria', 'coffee', 'bakery', 'grill',
+                              'kitchen', 'starbucks', 'mcdonalds', 'kfc', 'pizza', 'burger', 'shawarma',
+                              'tim hortons', 'costa'],
+    'healthcare': ['pharmacy', 'clinic', 'hospital', 'medical', 'dental', 'aster', 'optical', 'healthcare'],
+    'clothing': ['fashion', 'fashions', 'garment', 'garments', 'apparel', 'tailor', 'tailoring', 'zara',
+                 'centrepoint', 'splash', 'shoes', 'footwear'],
+    'jewelry': ['jewel', 'jewels', 'jewellery', 'jewelry', 'jewellers', 'diamond', 'diamonds', 'malabar',
+                'joyalukkas'],
+    'transportation': ['careem', 'uber', 'taxi', 'rta', 'salik', 'metro', 'parking', 'enoc', 'adnoc',
+                       'eppco', 'petrol', 'emarat', 'nol'],
+    'phone and internet': ['etisalat', 'du', 'telecom', 'mobile', 'virgin mobile', 'internet'],
+    'e-commerce': ['amazon', 'noon', 'aliexpress', 'shein', 'namshi', 'temu'],
+    'food delivery': ['talabat', 'deliveroo', 'zomato', 'noon food', 'smiles', 'uber eats', 'careem food',
+                      'careem now'],
+}
+
+# Keywords that are also common words or parts of other names ('Metro Mart', 'Kitchen Equipment Trading').
+# They only decide the category when they are the whole merchant name, otherwise the model must agree.
+GENERIC_KEYWORDS = {'metro', 'du', 'kitchen', 'smiles', 'mobile', 'viva', 'nol', 'splash', 'costa', 'emarat',
+                    'diamond', 'diamonds', 'noon', 'grill', 'shoes'}
+
+# Share of the words of a merchant name the model must have seen to be trusted.
+# A single known word ('al') says little about 'al fardan exchange'.
+MIN_KNOWN_WORDS = float(os.getenv('SPENDWISE_LOCAL_MIN_KNOWN_WORDS', 0.6))
+
+# Confidence of a category given by a specific keyword, and by a generic one alone
+KEYWORD_CONFIDENCE = 0.95
+GENERIC_KEYWORD_CONFIDENCE = 0.5
+
+
+def find_first_match(text, categories=CATEGORIES):
+    if not isinstance(text, str):
+        return None
+    for category in categories:
+        if category in text.lower():
+            return category
+    return None
+
+
+def tokenize(merchant):
+    """Split a merchant name into lowercase words and word pairs."""
+    words = re.findall(r'[a-z0-9&]+', merchant.lower())
+    words = [word for word in words if len(word) > 1 and not word.isdigit()]
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+
+class LocalClassifier:
+    """
+    In-process merchant classifier used before asking the LLM.
+
+    A keyword index recognises well known merchants and merchant types. A
+    multinomial naive Bayes model over the words of merchant names is trained
+    on the merchants the LLM already labelled (the merchant cache), and keeps
+    learning from new LLM answers. Predictions come with a confidence in
+    [0, 1].
+    """
+
+    def __init__(self, keywords=CATEGORY_KEYWORDS, examples=None, min_examples=20):
+        self.keyword_patterns = {
+            category: re.compile(r'(?<![a-z0-9])(?:' + '|'.join(re.escape(word) for word in words) + r')(?![a-z0-9])')
+            for category, words in keywords.items()
+        }
+        self.examples = examples
+        self.min_examples = min_examples
+        self.class_counts = Counter()
+        self.token_counts = defaultdict(Counter)
+        self.token_totals = Counter()
+        self.vocabulary = set()
+        self.resolved = 0
+        self.total = 0
+        self._loaded = examples is None
+        self._lock = threading.Lock()
+
+    def _ensure_loaded(self):
+        with self._lock:
+            if self._loaded:
+                return
+            self._loaded = True
+        try:
+            self.learn(dict(self.examples()))
+        except Exception as e:
+            logging.warning(f"Could not load the local classifier training data: {e}")
+
+    def learn(self, labelled):
+        """
+        Update the model with merchant -> category labels (e.g. LLM results).
+
+        Labels that are not one of CATEGORIES are ignored.
+        """
+        with self._lock:
+            for merchant, label in labelled.items():
+                category = find_first_match(label)
+                if category is None:
+                    continue
+                tokens = tokenize(merchant)
+                self.class_counts[category] += 1
+                self.token_counts[category].update(tokens)
+                self.token_totals[category] += len(tokens)
+                self.vocabulary.update(tokens)
+
+    def _model_scores(self, tokens, candidates):
+        n_examples = sum(self.class_counts.values())
+        vocabulary_size = len(self.vocabulary) + 1
+        log_scores = {}
+        for category in candidates:
+            score = math.log((self.class_counts[category] + 1) / (n_examples + len(CATEGORIES)))
+            for token in tokens:
+                score += math.log((self.token_counts[category][token] + 1) /
+                                  (self.token_totals[category] + vocabulary_size))
+            log_scores[category] = score
+        # Normalise the scores into probabilities
+        top = max(log_scores.values())
+        weights = {category: math.exp(score - top) for category, score in log_scores.items()}
+        total = sum(weights.values())
+        return {category: weight / total for category, weight in weights.items()}
+
+    def predict(self, merchant):
+        """
+        Predict the category of a merchant.
+
+        Returns:
+            tuple: The category (or None) and the confidence of the prediction.
+        """
+        self._ensure_loaded()
+        name = merchant.lower()
+        hits = {category: pattern.findall(name) for category, pattern in self.keyword_patterns.items()}
+        # A keyword inside a longer keyword of another category does not count ('uber' in 'uber eats')
+        phrases = [word for words in hits.values() for word in words if ' ' in word]
+        hits = {category: [word for word in words
+                           if not any(word != phrase and re.search(rf'(?<![a-z0-9]){re.escape(word)}(?![a-z0-9])',
+                                                                   phrase) for phrase in phrases)]
+                for category, words in hits.items()}
+        hits = {category: words for category, words in hits.items() if words}
+        matches = list(hits)
+        whole_name = ' '.join(re.findall(r'[a-z0-9&]+', name))
+        # Categories found by a specific keyword, generic ones only count as the whole name
+        specific = [category for category, words in hits.items()
+                    if any(word not in GENERIC_KEYWORDS or word == whole_name for word in words)]
+        if len(specific) == 1:
+            return specific[0], KEYWORD_CONFIDENCE
+
+        tokens = tokenize(merchant)
+        words = [token for token in tokens if ' ' not in token]
+        with self._lock:
+            known = [token for token in tokens if token in self.vocabulary]
+            # The model only scores the words it has seen, the others must not be the most of the name
+            known_words = sum(1 for word in words if word in self.vocabulary)
+            if (sum(self.class_counts.values()) < self.min_examples or not known
+                    or known_words < MIN_KNOWN_WORDS * len(words)):
+                return (matches[0], GENERIC_KEYWORD_CONFIDENCE) if matches else (None, 0.0)
+            # A generic keyword alone does not narrow down the candidates, the model has to find it
+            candidates = matches if len(matches) > 1 else CATEGORIES
+            probabilities = self._model_scores(known, candidates)
+        category = max(probabilities, key=probabilities.get)
+        return category, probabilities[category]
+
+    def classify(self, merchants, threshold=LOCAL_CONFIDENCE):
+        """
+        Classify the merchants that can be predicted with enough confidence.
+
+        Returns:
+            tuple: merchant -> category for the resolved merchants, and the
+            list of merchants left for the LLM.
+        """
+        resolved, unresolved = {}, []
+        for merchant in merchants:
+            category, confidence = self.predict(merchant)
+            if category is not None and confidence >= threshold:
+                resolved[merchant] = category
+            else:
+                unresolved.append(merchant)
+        with self._lock:
+            self.resolved += len(resolved)
+            self.total += len(resolved) + len(unresolved)
+        return resolved, unresolved
+
+    def stats(self):
+        """Return the number and fraction of merchants resolved locally."""
+        return {
+            'resolved': self.resolved,
+            'total': self.total,
+            'local_fraction': self.resolved / self.total if self.total else 0.0,
+        }
+
+
+local_classifier = LocalClassifier(examples=merchant_cache.items)
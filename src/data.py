@@ -1,20 +1,102 @@
 import os
-import pdfplumber
 import pandas as pd
 import logging
 import json
-import requests
 import re
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from src.cache import file_digest, statement_cache, merchant_cache, sql_cache, text_version
+from src.location import location_matcher
+from src.query import query_engine
+from src.storage import write_table, read_table
+from src.metrics import STAGE_ERRORS, count, stage, timed
+from src.llm import gateway
+from src.classifier import CATEGORIES, find_first_match, local_classifier
+from src.merchants import merchant_canonicalizer
+
+# Maximum number of worker processes used to extract tables from long statements (1: serial)
+PDF_WORKERS = int(os.getenv('SPENDWISE_PDF_WORKERS', 1))
+# Pages each extraction process gets at least, so that shorter statements are extracted
+# serially: starting the processes costs more than it saves on a few pages
+PDF_PAGES_PER_WORKER = int(os.getenv('SPENDWISE_PDF_PAGES_PER_WORKER', 20))
+
+# Bumped when the output of parse_transactions changes, to invalidate cached statements
+PARSER_VERSION = 3
+
+# Keep parsed transactions with compact dtypes (categoricals, Arrow strings), see compact_frame
+COMPACT_FRAMES = os.getenv('SPENDWISE_COMPACT_FRAMES', '1') == '1'
+
+# Merchants sent to the LLM per classification request, and concurrent requests
+CLASSIFY_BATCH_SIZE = int(os.getenv('SPENDWISE_CLASSIFY_BATCH_SIZE', 50))
+CLASSIFY_WORKERS = int(os.getenv('SPENDWISE_CLASSIFY_WORKERS', 4))
+
+
+def _extract_tables_from_pages(pdf_path, start, end):
+    """
+    Extract the tables of the pages in [start, end) of a PDF file.
+
+    Each call opens the PDF itself so that it can run in a worker process.
+    """
+    import pdfplumber
+
+    tables = []
+    with pdfplumber.open(pdf_path) as pdf:
+        for page in pdf.pages[start:end]:
+            page_tables = page.extract_tables()
+            if page_tables:
+                tables.extend(page_tables)
+    return tables
+
+
+def _split_pages(n_pages, n_chunks):
+    # Split the pages into contiguous, evenly sized ranges (one per worker)
+    size, extra = divmod(n_pages, n_chunks)
+    ranges = []
+    start = 0
+    for i in range(n_chunks):
+        end = start + size + (1 if i < extra else 0)
+        if end > start:
+            ranges.append((start, end))
+        start = end
+    return ranges
+
+
+def pdf_page_count(pdf_path):
+    """Number of pages of a PDF file."""
+    import pdfplumber
+
+    with pdfplumber.open(pdf_path) as pdf:
+        return len(pdf.pages)
+
+
+def _column_names(columns):
+    # Parquet needs unique string column names, name them the way read_csv does
+    names, seen = [], {}
+    for i, column in enumerate(columns):
+        name = f"Unnamed: {i}" if column is None or column == '' else str(column)
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        names.append(name)
+    return names
 
-def extract_table_from_pdf(pdf_path):
+
+@timed('ingest', 'extract')
+def extract_table_from_pdf(pdf_path, workers=1):
     """
-    Extract tables from a PDF file and save them as a CSV file.
+    Extract tables from a PDF file and save them as a Parquet file.
 
     Args:
         pdf_path (str): The path to the PDF file.
+        workers (int): Maximum number of processes used to extract the pages.
+            Statements of at least 2 * PDF_PAGES_PER_WORKER pages are split into
+            ranges handled in parallel, and the tables are merged back in page
+            order.
 
     Returns:
-        str: The path to the saved CSV file.
+        str: The path to the saved Parquet file, see src/storage.py.
     """
     try:
         # Extract the base name of the file (without extension)
@@ -23,18 +105,24 @@ def extract_table_from_pdf(pdf_path):
         # Get the directory path of the PDF file
         directory = os.path.dirname(pdf_path)
 
-        # Create the full CSV file path
-        csv_file_path = os.path.join(directory, f"{base_name}.csv")
-
-        # Open the PDF file
-        with pdfplumber.open(pdf_path) as pdf:
-            all_tables = []
-            # Iterate through the pages
-            for page in pdf.pages:
-                # Extract tables from the page
-                tables = page.extract_tables()
-                if tables:
-                    all_tables.extend(tables)
+        # Create the full Parquet file path
+        table_file_path = os.path.join(directory, f"{base_name}.parquet")
+
+        n_pages = pdf_page_count(pdf_path)
+        workers = min(workers or 1, os.cpu_count() or 1, n_pages // PDF_PAGES_PER_WORKER)
+        if workers > 1:
+            # Extract page ranges in parallel, executor.map keeps them in page order.
+            # Workers are spawned, not forked: this runs in threads of the servers.
+            ranges = _split_pages(n_pages, workers)
+            with ProcessPoolExecutor(max_workers=len(ranges),
+                                     mp_context=multiprocessing.get_context('spawn')) as executor:
+                results = executor.map(_extract_tables_from_pages,
+                                       [pdf_path] * len(ranges),
+                                       [start for start, _ in ranges],
+                                       [end for _, end in ranges])
+                all_tables = [table for tables in results for table in tables]
+        else:
+            all_tables = _extract_tables_from_pages(pdf_path, 0, n_pages)
 
         if not all_tables:
             logging.warning(f"No tables found in the PDF file: {pdf_path}")
@@ -46,15 +134,18 @@ def extract_table_from_pdf(pdf_path):
         # Concatenate all DataFrames
         final_df = pd.concat(df_list, ignore_index=True)
 
-        # Save the final DataFrame to a CSV file
-        final_df.to_csv(csv_file_path, index=False)
+        # Save the final DataFrame to a Parquet file
+        final_df.columns = _column_names(final_df.columns)
+        write_table(final_df, table_file_path)
 
-        logging.info(f"Tables extracted and saved to '{csv_file_path}'.")
+        logging.info(f"Tables extracted and saved to '{table_file_path}'.")
+        count('ingest', 'extract', 'rows', len(final_df))
 
-        return csv_file_path
+        return table_file_path
 
     except Exception as e:
         logging.error(f"An error occurred: {e}")
+        STAGE_ERRORS.inc(pipeline='ingest', stage='extract')
         return ""
 
 # Example usage:
@@ -64,109 +155,179 @@ def extract_table_from_pdf(pdf_path):
 #    extract_table_from_pdf(pdf_path)
 
 
+def iter_statement_batches(pdf_path, batch_size=1000):
+    """
+    Extract the tables of a PDF file page by page, yielding their rows in batches.
+
+    Only one page and at most `batch_size` rows are held in memory at a time,
+    so large statements can be processed without building the full table.
+
+    Args:
+        pdf_path (str): The path to the PDF file.
+        batch_size (int): Maximum number of rows per yielded DataFrame.
+
+    Yields:
+        pd.DataFrame: A batch of table rows, using the table header as columns.
+    """
+    import pdfplumber
+
+    header, rows = None, []
+    with pdfplumber.open(pdf_path) as pdf:
+        for page in pdf.pages:
+            for table in page.extract_tables():
+                if not table:
+                    continue
+                # Flush the pending rows when a table with a different header starts
+                if rows and table[0] != header:
+                    yield pd.DataFrame(rows, columns=header)
+                    rows = []
+                header = table[0]
+                rows.extend(table[1:])
+                while len(rows) >= batch_size:
+                    yield pd.DataFrame(rows[:batch_size], columns=header)
+                    rows = rows[batch_size:]
+            # Release the layout objects pdfplumber caches for the page
+            page.close()
+    if rows:
+        yield pd.DataFrame(rows, columns=header)
+
+
+def iter_transactions(pdf_path, batch_size=1000):
+    """
+    Stream the parsed transactions of a PDF bank statement.
+
+    Args:
+        pdf_path (str): The path to the PDF file.
+        batch_size (int): Maximum number of table rows parsed at a time.
+
+    Yields:
+        pd.DataFrame: Batches of parsed transactions (see `parse_transactions`).
+    """
+    for batch in iter_statement_batches(pdf_path, batch_size):
+        df = parse_transactions(batch)
+        if not df.empty:
+            yield df
+
+
+def statement_key(pdf_path):
+    """Cache key of a statement: its content hash and the parser version."""
+    return f"{file_digest(pdf_path)}-v{PARSER_VERSION}"
+
+
+def load_transactions(pdf_path, cache=statement_cache):
+    """
+    Extract and parse the transactions of a PDF bank statement.
+
+    Results are cached by the hash of the PDF content, so uploading the same
+    statement again skips the extraction and parsing.
+
+    Args:
+        pdf_path (str): The path to the PDF file.
+        cache (StatementCache): The cache to use, or None to disable caching.
+
+    Returns:
+        pd.DataFrame: The parsed transactions, or None if no tables were found.
+    """
+    key = statement_key(pdf_path)
+    df = cache.get(key) if cache is not None else None
+    if df is not None:
+        logging.info(f"Reusing cached transactions for '{pdf_path}' ({cache.stats()})")
+        # Entries cached with the other dtype setting are converted
+        return compact_frame(df) if COMPACT_FRAMES else df
+
+    table_path = extract_table_from_pdf(pdf_path, workers=PDF_WORKERS)
+    if not table_path:
+        return None
+
+    df = parse_transactions(read_table(table_path))
+    if cache is not None:
+        cache.put(key, df)
+    return df
+
+
+# Regex patterns for parsing transactions
+pattern_card = re.compile(
+    r'CARD NO\.(?P<card_number>\d+\*{8}\d{4}) (?P<merchant>.+):(?P<country_code>[A-Z]{2}) '
+    r'(?P<transaction_id>\d+) (?P<date>\d{2}-\d{2}-\d{4}) (?P<amount>[\d\.]+),(?P<currency>[A-Z]+)'
+)
+
+
+def bytes_per_row(df):
+    """Memory used by a DataFrame per row, counting the content of strings."""
+    return df.memory_usage(deep=True).sum() / max(len(df), 1)
+
+
+# function to store the columns of parsed transactions with compact dtypes
+def compact_frame(df, max_unique_fraction=0.5):
+    """
+    Store string columns as categoricals when their values repeat (merchants,
+    locations, categories), and as Arrow strings otherwise (transaction ids).
+
+    Amounts stay float64: float32 cannot hold every amount to the cent, and
+    the amount is part of the key identifying a transaction in the database.
+
+    Returns:
+        pd.DataFrame: The compacted copy of `df`.
+    """
+    columns = {}
+    for column in df.columns:
+        values = df[column]
+        # Parquet files give back Arrow strings as Python strings
+        if values.dtype == object or (isinstance(values.dtype, pd.StringDtype) and values.dtype.storage != 'pyarrow'):
+            if values.nunique() <= max_unique_fraction * len(values):
+                values = values.astype('category')
+            else:
+                values = values.astype('string[pyarrow]')
+        columns[column] = values
+    return pd.DataFrame(columns, index=df.index)
+
+
 # Function to process the DataFrame and parse transactions
-def parse_transactions(df):
-    # Load the data
-    
-    df = df.rename(columns={'Date':'Date0'})
-    
+@timed('ingest', 'parse')
+def parse_transactions(df, compact=COMPACT_FRAMES):
+    """
+    Parse the card transactions out of the 'Description' column of a statement.
+
+    The patterns are matched column-wide with `Series.str.extract`. Rows that
+    are not card transactions (e.g. 'IPI TT REF' transfers) have no merchant
+    and are dropped.
+
+    Args:
+        df (pd.DataFrame): The statement table.
+        compact (bool): Return the columns with compact dtypes, see
+            `compact_frame`.
+
+    Returns:
+        pd.DataFrame: The 'Merchant', 'Location', 'Date', 'Amount' and
+        'Transaction ID' columns of the card transactions.
+    """
     # Drop rows where all elements are NaN
     df = df.dropna(how='all')
-    
+
     # Replace newline characters in 'Description' column
-    df['Description'] = df['Description'].str.replace('\n', ' ')
-    
-    # List of UAE cities
-    uae_cities = ['Dubai', 'Abu Dhabi', 'Sharjah', 'Ajman', 'Ras Al Khaimah', 'Fujairah', 'Umm Al Quwain', 'Al Ain']
-    
-    # Function to extract city name from a string
-    def extract_city_name(name):
-        for city in uae_cities:
-            if city.lower() in name.lower():
-                return city
-        return ''
-    
-    # Function to replace a substring in a string, ignoring case
-    def replace_ignore_case(original_str, old_substr, new_substr):
-        pattern = re.compile(re.escape(old_substr), re.IGNORECASE)
-        return pattern.sub(new_substr, original_str)
-    
-    # Regex patterns for parsing transactions
-    pattern_card = re.compile(
-        r'CARD NO\.(\d+\*{8}\d{4}) (.+):([A-Z]{2}) (\d+) (\d{2}-\d{2}-\d{4}) ([\d\.]+),([A-Z]+)'
-    )
-    
-    pattern_ipi = re.compile(
-        r'IPI TT REF: (\w+) ([^\d\s]+ [^\d\s]+ [^\d\s]+) (.+)$'
-    )
-    
-    # Function to parse a transaction description
-    def parse_transaction(transaction):
-        card_match = pattern_card.search(transaction)
-        ipi_match = pattern_ipi.search(transaction)
-        
-        if card_match:
-            merchant_and_city = card_match.group(2).strip()
-            city = extract_city_name(merchant_and_city)
-            merchant = replace_ignore_case(merchant_and_city, city, "")
-            
-            return {
-                "Card Number": card_match.group(1),
-                "Merchant": merchant,
-                "Location": city,
-                "Country Code": card_match.group(3).strip(),
-                "Transaction ID": card_match.group(4),
-                "Date": card_match.group(5),
-                "Amount": card_match.group(6),
-                "Currency": card_match.group(7)
-            }
-        elif ipi_match:
-            reference = ipi_match.group(1)
-            details = ipi_match.group(2)
-            return {
-                'Card Number': None,
-                'Merchant': None,
-                "Location": None,
-                "Country Code": None,
-                "Transaction ID": None,
-                'Date': None,
-                'Amount': None,
-                'Currency': None,
-                'Reference': reference,
-                'Details': details
-            }
-        else:
-            return {
-                'Card Number': None,
-                'Merchant': None,
-                "Location": None,
-                "Country Code": None,
-                "Transaction ID": None,
-                'Date': None,
-                'Amount': None,
-                'Currency': None,
-                'Reference': None,
-                'Details': None
-            }
-    
-    # Apply parsing function to each row in the DataFrame
-    df_parsed = df['Description'].apply(parse_transaction).apply(pd.Series)
-    
-    # Combine parsed information with the original DataFrame
-    df_final = pd.concat([df, df_parsed], axis=1)
-    df_final['Date'] = pd.to_datetime(df_final['Date'],dayfirst=True)
-    df_final['Amount'] = pd.to_numeric(df_final['Amount'])
-    df_final.fillna({
-        'Debits': 0,
-        'Credits': 0,
-        'Balance': 0,
-        'Amount': 0
-        }, inplace=True)
-
-    df_final = df_final.dropna(how='all')
-    df_final = df_final.dropna(subset=['Merchant'])
-    cols = ['Merchant','Location','Date', 'Amount']
-    df_final = df_final.filter(cols)
+    descriptions = df['Description'].astype(str).str.replace('\n', ' ', regex=False)
+
+    # Extract the card transaction fields of every row at once
+    card = descriptions.str.extract(pattern_card)
+    card = card[card['merchant'].notna()]
+
+    merchant, location = location_matcher.split(card['merchant'].str.strip())
+
+    df_final = pd.DataFrame({
+        'Merchant': merchant,
+        'Location': location,
+        'Date': pd.to_datetime(card['date'], format='%d-%m-%Y'),
+        'Amount': pd.to_numeric(card['amount']),
+        'Transaction ID': card['transaction_id'],
+    }, index=card.index)
+
+    count('ingest', 'parse', 'rows', len(df))
+    count('ingest', 'parse', 'transactions', len(df_final))
+    if compact:
+        wide = bytes_per_row(df_final)
+        df_final = compact_frame(df_final)
+        logging.info(f"Parsed {len(df_final)} transactions: {bytes_per_row(df_final):.0f} bytes/row "
+                     f"(compact), {wide:.0f} bytes/row (object dtypes)")
 
     return df_final
 
@@ -174,102 +335,175 @@ def parse_transactions(df):
 # df_final = process_transactions('path_to_your_file.csv')
 # print(df_final)
 
-import time
-
-def fetch_with_retry(url: str, headers: dict, payload: dict, max_retries: int = 5):
-    for attempt in range(max_retries):
-        try:
-            response = requests.post(url, headers=headers, data=payload)
-            
-            if response.status_code == 429:  # Rate limit exceeded
-                retry_after = response.headers.get("Retry-After")
-                if retry_after is None:
-                    retry_after = response.json().get("retry_after", 1)  # Fallback to 1 second if not provided
-                retry_after = int(retry_after)
-                
-                print(f"Rate limit exceeded. Retrying after {retry_after} seconds...")
-                time.sleep(retry_after)
-            else:
-                # Successful response or other status code
-                response.raise_for_status()  # Will raise an HTTPError for bad responses (4xx and 5xx)
-                return response.json()
-        
-        except requests.RequestException as e:
-            print(f"Request failed: {e}")
-            time.sleep(1)  # Short sleep before retrying in case of connection errors or timeouts
-
-    raise Exception("Max retries exceeded")
-
 def classify_company(user_content):
-    url = "https://api.ai71.ai/v1/chat/completions"
-    AI71_TOKEN = os.getenv('AI71_TOKEN')
-
-    categories = [
-    'fitness',
-    'groceries',
-    'restaurants and cafes',
-    'healthcare', 
-    'clothing',
-    'jewelry',
-    'transportation',
-    'phone and internet', 
-    'miscellaneous',
-    'others',
-    'e-commerce',
-    'food delivery'
-    ]
-
-    categories_str = ', '.join(categories)
+    categories_str = ', '.join(CATEGORIES)
 
     role_content = (
         f"You will be provided with company names, and your task is to classify them to one of the following "
         f"{categories_str}"
         f" return them formated as json where field is company name and value is category"
     )
-    
-    payload = json.dumps({
-        "model": "tiiuae/falcon-180b-chat",
-        "messages": [
-            {
-                "role": "system",
-                "content": role_content
-            },
-            {
-                "role": "user",
-                "content": user_content
-            }
-        ]
-    })
-    
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer {AI71_TOKEN}'
-    }
-    
-    #response = requests.post(url, headers=headers, data=payload)
-    response = fetch_with_retry(url, headers, payload)
 
-    try:
-        choices = response.get('choices', [])
-        if choices:
-            result = choices[0].get('message', {}).get('content', '').strip()
-            return result
-        else:
-            return None
-            
-    except ValueError:
-        return None
+    messages = [
+        {
+            "role": "system",
+            "content": role_content
+        },
+        {
+            "role": "user",
+            "content": user_content
+        }
+    ]
+
+    # Shared AI71 client (pooled connections, rate limiting, retries), see src/llm.py
+    return gateway.chat(messages, model="tiiuae/falcon-180b-chat")
 
-import os
-import json
-import requests
-import pandas as pd
-from pandasql import sqldf
 
+def _classify_batch(classify, merchants):
+    results = classify(', '.join(merchants))
+    if results is None:
+        raise ValueError("No classification returned")
+    return {k.strip().lower(): v for k, v in json.loads(results).items()}
+
+
+# function to classify merchants in concurrent batches
+@timed('ingest', 'classify')
+def classify_merchants(merchants, classify=classify_company, batch_size=CLASSIFY_BATCH_SIZE,
+                       workers=CLASSIFY_WORKERS, max_attempts=3):
+    """
+    Classify merchants with the LLM, `batch_size` merchants per request.
+
+    The batches are sent concurrently (requests go through the shared AI71
+    client of src/llm.py). A batch whose request fails or whose answer
+    is not valid JSON is retried on its own, up to `max_attempts` times.
+
+    Args:
+        merchants (list): Lowercased merchant names.
+        classify (callable): Function classifying a comma separated list of
+            company names, returning a JSON object of name -> category.
+
+    Returns:
+        dict: merchant -> category for the merchants that were classified.
+    """
+    pending = [merchants[i:i + batch_size] for i in range(0, len(merchants), batch_size)]
+    categories = {}
+    for attempt in range(max_attempts):
+        if not pending:
+            break
+        failed = []
+        with ThreadPoolExecutor(max_workers=min(workers, len(pending))) as executor:
+            futures = {executor.submit(_classify_batch, classify, batch): batch for batch in pending}
+            for future in as_completed(futures):
+                try:
+                    categories.update(future.result())
+                except Exception as e:
+                    logging.warning(f"Classification of {len(futures[future])} merchants failed: {e}")
+                    failed.append(futures[future])
+        pending = failed
+
+    count('ingest', 'classify', 'merchants', len(merchants))
+    if pending:
+        logging.error(f"Could not classify {sum(len(batch) for batch in pending)} merchants")
+        count('ingest', 'classify', 'unclassified', sum(len(batch) for batch in pending))
+    requested = set(merchants)
+    return {k: v for k, v in categories.items() if k in requested}
+
+
+# function to map the spellings of each merchant to one canonical key
+@timed('ingest', 'canonicalize')
+def canonicalize_merchants(merchants, canonicalizer=merchant_canonicalizer):
+    """
+    Map merchant names to canonical keys, so 'NESTO HYPERMARKET LLC BRA' and
+    'Nesto Hypermarket' are classified, grouped and stored as one merchant.
+
+    Args:
+        merchants (pd.Series): Merchant names, as parsed from the statement.
+        canonicalizer (MerchantCanonicalizer): The matcher to use.
+
+    Returns:
+        pd.Series: The canonical keys, categorical if `merchants` was.
+    """
+    keys = canonicalizer.canonicalize(merchants)
+    count('ingest', 'canonicalize', 'spellings', merchants.nunique())
+    count('ingest', 'canonicalize', 'merchants', keys.nunique())
+    return keys
+
+
+# function to add the spending category of each transaction
+@timed('ingest', 'categorize')
+def categorize_transactions(df, classify=classify_company, category_map=None, cache=merchant_cache,
+                            local=local_classifier, canonicalizer=merchant_canonicalizer):
+    """
+    Classify the merchants of parsed transactions and add their categories.
+
+    Args:
+        df (pd.DataFrame): Parsed transactions (see `parse_transactions`).
+        classify (callable): Function classifying a comma separated list of
+            company names, returning a JSON object of name -> category.
+        category_map (dict): Optional merchant -> category mapping. Merchants
+            already in it are not classified again, and new results are added
+            to it, so it can be shared across the batches of a statement.
+        cache (MerchantCategoryCache): Persistent store consulted before the
+            LLM, so only merchants never seen before are classified. None
+            disables it.
+        local (LocalClassifier): In-process classifier tried before the LLM,
+            only the merchants it is not confident about are sent to the LLM.
+            None disables it.
+        canonicalizer (MerchantCanonicalizer): Maps the spellings of a
+            merchant (suffixes, store numbers, truncations) to one key before
+            classification. None only lowercases the names.
+
+    Returns:
+        pd.DataFrame: The transactions with canonical `Merchant` keys and the
+        `Category_freetext` and `Category` columns.
+    """
+    if category_map is None:
+        category_map = {}
+
+    if canonicalizer is not None:
+        df['Merchant'] = canonicalize_merchants(df['Merchant'], canonicalizer)
+    elif isinstance(df['Merchant'].dtype, pd.CategoricalDtype):
+        # Only the distinct names are lowercased, and the column stays categorical
+        df['Merchant'] = df['Merchant'].map(lambda merchant: merchant.strip().lower()).astype('category')
+    else:
+        df['Merchant'] = df['Merchant'].str.strip().str.lower()
+
+    merchants = [merchant for merchant in df['Merchant'].drop_duplicates() if merchant not in category_map]
+    if merchants and cache is not None:
+        cached = cache.get_many(merchants)
+        count('ingest', 'categorize', 'merchants_cached', len(cached))
+        category_map.update(cached)
+        merchants = [merchant for merchant in merchants if merchant not in category_map]
+
+    if merchants and local is not None:
+        resolved, unresolved = local.classify(merchants)
+        logging.info(f"Classified {len(resolved)} of {len(merchants)} merchants locally "
+                     f"({local.stats()['local_fraction']:.0%} of all merchants so far)")
+        count('ingest', 'categorize', 'merchants_local', len(resolved))
+        category_map.update(resolved)
+        merchants = unresolved
+
+    if merchants:
+        count('ingest', 'categorize', 'merchants_llm', len(merchants))
+        classified = classify_merchants(merchants, classify)
+        category_map.update(classified)
+        if local is not None:
+            local.learn(classified)
+        if cache is not None:
+            cache.put_many(classified)
+
+    df['Category_freetext'] = df['Merchant'].map(category_map)
+    df['Category'] = df['Category_freetext'].apply(find_first_match)
+    if isinstance(df['Merchant'].dtype, pd.CategoricalDtype):
+        df['Category_freetext'] = df['Category_freetext'].astype('category')
+        df['Category'] = df['Category'].astype('category')
+    return df
+
+
+# function to write the SQL answering a request, with the prompt version to cache it under
+# once it ran (None when the query came from the cache)
+@timed('ask', 'sql_generation')
 def get_sql_query(user_request):
-    url = "https://api.ai71.ai/v1/chat/completions"
-    AI71_TOKEN = os.getenv('AI71_TOKEN')
-    
     role_content = """Given the following SQL table, your job is to write queries given a user’s request.
 CREATE TABLE df (
     Date DATE,
@@ -314,40 +548,29 @@ Output: ["Groceries", "E-commerce"]
 Note: The word "apple" can refer to both the fruit (Groceries) and the brand (E-commerce).
 
 """
+
+    # Questions asked before with the same prompt skip the LLM
+    version = text_version(role_content)
+    cached_query = sql_cache.get('dataframe', user_request, version)
+    if cached_query is not None:
+        return cached_query, None
     
-    payload = json.dumps({
-        "model": "tiiuae/falcon-180b-chat",
-        "messages": [
-            {
-                "role": "system",
-                "content": role_content
-            },
-            {
-                "role": "user",
-                "content": user_request
-            }
-        ]
-    })
-    
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer {AI71_TOKEN}'
-    }
-    
-    response = requests.request("POST", url, headers=headers, data=payload)
-    
-    try:
-        response_json = response.json()
-        choices = response_json.get('choices', [])
-        if choices:
-            message_content = choices[0].get('message', {}).get('content', '')
-            query = message_content.strip()
-            return query
-        else:
-            return "No choices found in the response."
-    except ValueError:
-        return "Response is not in JSON format: " + response.text
-import pandas as pd
+    messages = [
+        {
+            "role": "system",
+            "content": role_content
+        },
+        {
+            "role": "user",
+            "content": user_request
+        }
+    ]
+
+    query = gateway.chat(messages, model="tiiuae/falcon-180b-chat")
+    if not query:
+        return "No choices found in the response.", None
+    return query, version
+
 
 def format_table_as_text(df):
     # Determine column widths
@@ -365,14 +588,28 @@ def format_table_as_text(df):
     return f"{header}\n{separator}\n{rows}"
 
 
-def execute_query_and_display(user_request, df,markdown=True):
+def execute_query_and_display(user_request, df=None, markdown=True, engine=query_engine):
+    """
+    Answer a question with SQL run on the transactions of `engine`.
+
+    Args:
+        df (pd.DataFrame): The transactions to query. Registering the same
+            DataFrame again is free; leave it out to query the data already
+            registered (e.g. with engine.register_file).
+    """
+    if df is not None:
+        engine.register(df)
     # Get the SQL query from the AI71 API
     user_request = 'Write a SQL query which answers' + user_request
-    sql_query = get_sql_query(user_request)
+    sql_query, version = get_sql_query(user_request)
     
     if "SELECT" in sql_query:  # simple check if the response seems like a SQL query
         try:
-            result = sqldf(sql_query.lower(), locals())
+            with stage('ask', 'sql_execution'):
+                result = engine.query(sql_query.lower())
+            if version is not None:
+                # The query ran, reuse it the next time the question is asked
+                sql_cache.put('dataframe', user_request, version, sql_query)
             if markdown:
                 result_text = result.to_markdown(index=False)#format_table_as_text(result)
                 markdown_content = f"### Here’s what we found:\n```\n{result_text}\n```\n### We ran the following SQL query:\n```sql\n{sql_query}\n```\n\n"
@@ -380,6 +617,6 @@ def execute_query_and_display(user_request, df,markdown=True):
             else:
                 return result.to_dict(orient='records')
         except Exception as e:
-            print(f"Error executing query: {e}")
+            logging.error(f"Error executing query: {e}")
     else:
-        print(sql_query)
\ No newline at end of file
+        logging.warning(f"The model did not return a SQL query: {sql_query}")
\ No newline at end of file
@@ -0,0 +1,253 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from src.metrics import LLM_REQUESTS, LLM_SECONDS
+
+# Point at a local stand-in (see benchmarks/mock_ai71.py) to test without using the API quota
+AI71_BASE_URL = os.getenv('AI71_BASE_URL', 'https://api.ai71.ai/v1/')
+
+# Requests per second allowed to the AI71 API, and the size of bursts
+LLM_RATE = float(os.getenv('SPENDWISE_LLM_RATE', 2))
+LLM_BURST = int(os.getenv('SPENDWISE_LLM_BURST', 4))
+# Requests in flight at the same time (also the size of the connection pool)
+LLM_MAX_CONCURRENCY = int(os.getenv('SPENDWISE_LLM_MAX_CONCURRENCY', 8))
+# Seconds to connect, and to wait for the model's answer
+LLM_CONNECT_TIMEOUT = float(os.getenv('SPENDWISE_LLM_CONNECT_TIMEOUT', 10))
+LLM_READ_TIMEOUT = float(os.getenv('SPENDWISE_LLM_READ_TIMEOUT', 120))
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter.
+
+    `acquire` blocks until a token is available. `pause` stops handing out
+    tokens for a while, e.g. when the server answers 429 with Retry-After,
+    so every thread sharing the bucket backs off together.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                else:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
+            self._updated = max(self._updated, self._paused_until)
+
+
+def retry_after_seconds(response, default=1.0):
+    """Read the delay requested by a 429 response, in seconds."""
+    retry_after = response.headers.get("Retry-After")
+    if retry_after is None:
+        try:
+            retry_after = response.json().get("retry_after", default)
+        except ValueError:
+            retry_after = default
+    try:
+        return max(float(retry_after), 0.0)
+    except (TypeError, ValueError):
+        return default
+
+
+class AI71Client:
+    """
+    Shared client for the AI71 chat completions API.
+
+    All requests of the process go through one pooled keep-alive session, a
+    shared rate limiter and a cap on the requests in flight. Connection
+    errors and 5xx answers are retried with exponential backoff, 429 answers
+    pause the rate limiter for their Retry-After delay. The latency of every
+    call is recorded, see `stats`.
+    """
+
+    def __init__(self, base_url=AI71_BASE_URL, rate=LLM_RATE, burst=LLM_BURST,
+                 max_concurrency=LLM_MAX_CONCURRENCY, timeout=(LLM_CONNECT_TIMEOUT, LLM_READ_TIMEOUT),
+                 max_retries=5):
+        self.base_url = base_url.rstrip('/') + '/'
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.rate_limiter = TokenBucket(rate, burst)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._stats = {'calls': 0, 'errors': 0, 'retries': 0, 'rate_limited': 0, 'latency_total': 0.0,
+                       'latency_max': 0.0}
+
+    def _headers(self):
+        # Both variable names have been used for the key across the project
+        api_key = os.getenv('AI71_API_KEY') or os.getenv('AI71_TOKEN')
+        return {
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {api_key}'
+        }
+
+    def _record(self, name, latency=None):
+        with self._lock:
+            self._stats[name] += 1
+            if latency is not None:
+                self._stats['latency_total'] += latency
+                self._stats['latency_max'] = max(self._stats['latency_max'], latency)
+        LLM_REQUESTS.inc(outcome=name)
+        if latency is not None:
+            LLM_SECONDS.observe(latency)
+
+    def _release_on_close(self, response):
+        # A streamed body is read after post returns, the slot is held until the response is closed
+        close = response.close
+        released = []
+
+        def close_and_release():
+            try:
+                close()
+            finally:
+                if not released:
+                    released.append(True)
+                    self._slots.release()
+        response.close = close_and_release
+
+    def post(self, path, payload, stream=False):
+        """
+        POST a JSON payload to an API path, retrying when it makes sense.
+
+        With stream=True the response counts against the concurrency limit
+        until it is closed, so the caller must close it.
+
+        Returns:
+            requests.Response: The successful response.
+        """
+        url = self.base_url + path.lstrip('/')
+        for attempt in range(self.max_retries):
+            if attempt:
+                self._record('retries')
+            self.rate_limiter.acquire()
+            start = time.perf_counter()
+            self._slots.acquire()
+            try:
+                response = self.session.post(url, headers=self._headers(), json=payload,
+                                             timeout=self.timeout, stream=stream)
+            except requests.RequestException as e:
+                self._slots.release()
+                logging.warning(f"AI71 request failed: {e}")
+                time.sleep(min(0.5 * 2 ** attempt, 10) + random.random() * 0.5)
+                continue
+            if stream and response.ok:
+                self._release_on_close(response)
+            else:
+                if stream:
+                    # Error bodies are small, read them before the connection goes back to the pool
+                    _ = response.content
+                    response.close()
+                self._slots.release()
+
+            if response.status_code == 429:  # Rate limit exceeded
+                self._record('rate_limited')
+                retry_after = retry_after_seconds(response)
+                logging.warning(f"Rate limit exceeded. Retrying after {retry_after} seconds...")
+                # Hold back every thread using the client, not just this one
+                self.rate_limiter.pause(retry_after)
+                continue
+            if response.status_code >= 500:
+                logging.warning(f"AI71 server error {response.status_code}")
+                time.sleep(min(0.5 * 2 ** attempt, 10) + random.random() * 0.5)
+                continue
+            if response.status_code >= 400:
+                # Other 4xx answers are not worth retrying
+                self._record('errors')
+                response.raise_for_status()
+
+            self._record('calls', time.perf_counter() - start)
+            return response
+
+        self._record('errors')
+        raise Exception("Max retries exceeded")
+
+    def chat(self, messages, model="tiiuae/falcon-180b-chat", **params):
+        """
+        Run a chat completion.
+
+        Args:
+            messages (list): The messages, as {'role': ..., 'content': ...} dicts.
+            model (str): The model name.
+            **params: Other request parameters, e.g. temperature.
+
+        Returns:
+            str: The content of the answer, or None if there was no answer.
+        """
+        response = self.post('chat/completions', {"model": model, "messages": messages, **params})
+        try:
+            choices = response.json().get('choices', [])
+        except ValueError:
+            return None
+        if not choices:
+            return None
+        return choices[0].get('message', {}).get('content', '').strip()
+
+    def stream_chat(self, messages, model="tiiuae/falcon-180b-chat", **params):
+        """
+        Run a chat completion, yielding the answer as the model writes it.
+
+        The answer is read from the server-sent events of a streamed
+        completion ('data: {...}' lines, ended by 'data: [DONE]').
+
+        Yields:
+            str: The successive pieces of the answer.
+        """
+        response = self.post('chat/completions', {"model": model, "messages": messages, "stream": True, **params},
+                             stream=True)
+        try:
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith('data:'):
+                    continue
+                data = line[len('data:'):].strip()
+                if data == '[DONE]':
+                    break
+                try:
+                    choices = json.loads(data).get('choices', [])
+                except ValueError:
+                    logging.warning(f"Skipping malformed stream event: {data[:100]}")
+                    continue
+                if choices:
+                    content = choices[0].get('delta', {}).get('content')
+                    if content:
+                        yield content
+        finally:
+            response.close()
+
+    def stats(self):
+        """Return the call counters and latencies (in seconds) of the client."""
+        with self._lock:
+            stats = dict(self._stats)
+        stats['latency_avg'] = stats['latency_total'] / stats['calls'] if stats['calls'] else 0.0
+        return stats
+
+
+# Shared by every AI71 call of the process
+gateway = AI71Client()
@@ -0,0 +1,117 @@
+import logging
+import os
+import re
+
+# List of UAE cities
+UAE_CITIES = ['Dubai', 'Abu Dhabi', 'Sharjah', 'Ajman', 'Ras Al Khaimah', 'Fujairah', 'Umm Al Quwain', 'Al Ain']
+
+# Optional text file with extra locations, one per line
+GAZETTEER_PATH = os.getenv('SPENDWISE_GAZETTEER')
+
+
+def load_gazetteer(path):
+    """
+    Read a list of locations from a text file (one per line, '#' for comments).
+
+    Args:
+        path (str): The path to the gazetteer file.
+
+    Returns:
+        list: The location names.
+    """
+    with open(path, encoding='utf-8') as f:
+        lines = (line.strip() for line in f)
+        return [line for line in lines if line and not line.startswith('#')]
+
+
+def _trie_pattern(words):
+    """
+    Build a regex matching any of `words` from a trie of their characters.
+
+    Words sharing a prefix share the start of the pattern, so matching at a
+    position costs about the length of the longest word instead of the
+    number of words.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def build(node):
+        end = '' in node
+        branches = [(r'\s+' if char == ' ' else re.escape(char)) + build(child)
+                    for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        if len(branches) == 1 and not end:
+            return branches[0]
+        pattern = '(?:' + '|'.join(branches) + ')'
+        return pattern + '?' if end else pattern
+
+    return build(trie)
+
+
+class LocationMatcher:
+    """
+    Find and strip known locations (whole words, any case) in merchant names.
+
+    The locations are compiled once into a single regex, so the cost of a
+    lookup does not grow with the size of the gazetteer.
+    """
+
+    def __init__(self, locations):
+        # Map the lowercased names to their spelling, the first spelling wins
+        self.locations = {}
+        for location in locations:
+            key = ' '.join(location.lower().split())
+            if key:
+                self.locations.setdefault(key, location)
+        # The location is the last words of the field, before the country code:
+        # 'ABU DHABI COOP DUBAI' is the Abu Dhabi Coop in Dubai
+        self.pattern = re.compile(r'(?<!\w)(' + _trie_pattern(self.locations) + r')\W*$', re.IGNORECASE)
+
+    def split_one(self, name):
+        """
+        Split the location ending a merchant name out of it.
+
+        Only that occurrence is removed, a location earlier in the name is
+        part of the merchant name ('AL AIN FARMS ABU DHABI').
+
+        Returns:
+            tuple: The name without the location, and the location ('' if none).
+        """
+        match = self.pattern.search(name)
+        if match is None:
+            return name, ''
+        key = ' '.join(match.group(1).lower().split())
+        return name[:match.start()].rstrip(), self.locations[key]
+
+    def split(self, names):
+        """
+        Split the locations out of a Series of merchant names.
+
+        Each distinct name is matched once.
+
+        Returns:
+            tuple: The merchant names without location and the locations, as
+            two Series with the index of `names`.
+        """
+        parts = {name: self.split_one(name) for name in names.unique()}
+        merchant = names.map({name: part[0] for name, part in parts.items()})
+        location = names.map({name: part[1] for name, part in parts.items()})
+        return merchant, location
+
+
+def build_location_matcher():
+    locations = list(UAE_CITIES)
+    if GAZETTEER_PATH:
+        try:
+            locations += load_gazetteer(GAZETTEER_PATH)
+        except OSError as e:
+            logging.error(f"Could not read the gazetteer '{GAZETTEER_PATH}': {e}")
+    return LocationMatcher(locations)
+
+
+location_matcher = build_location_matcher()
@@ -0,0 +1,175 @@
+import difflib
+import logging
+import os
+import re
+import threading
+from collections import defaultdict
+import pandas as pd
+from src.cache import merchant_cache
+
+# Minimum difflib similarity for a spelling to join an existing merchant
+MERCHANT_MATCH_THRESHOLD = float(os.getenv('SPENDWISE_MERCHANT_MATCH_THRESHOLD', 0.88))
+
+# Trailing words of statement merchant names that do not identify the merchant:
+# legal forms, branch markers and the like
+MERCHANT_SUFFIXES = {'llc', 'l', 'fze', 'fzco', 'fzc', 'fz', 'fzllc', 'est', 'establishment', 'trading', 'tr',
+                     'co', 'company', 'ltd', 'limited', 'inc', 'plc', 'pjsc', 'psc', 'sole', 'prop', 'bra', 'br',
+                     'brn', 'branch', 'no'}
+
+# Branch and store IDs: '#12', 'BR12', 'NO12', or numbers of 3 or more digits ('ENOC 1043').
+# Shorter numbers are often part of the name ('GYM 24', 'CAFE NO 5').
+_STORE_NUMBER = re.compile(r'#\d+|br\d+|no\d+|\d{3,}')
+_DOMAIN = re.compile(r'\.(?:com|ae|net|org|co)\b')
+
+# Words before a branch number of any length ('NESTO HYPERMARKET BR 12')
+BRANCH_MARKERS = {'br', 'brn', 'branch'}
+
+# Words shared by many merchants, a fuzzy match must agree on the other ones
+# ('al maha supermarket' is not 'al maya supermarket')
+GENERIC_MERCHANT_WORDS = {'al', 'el', 'the', 'and', 'of', 'supermarket', 'hypermarket', 'hyper', 'super', 'market',
+                          'mart', 'grocery', 'groceries', 'foodstuff', 'foodstuffs', 'food', 'foods', 'restaurant',
+                          'restaurants', 'cafe', 'cafeteria', 'coffee', 'bakery', 'kitchen', 'store', 'stores', 'shop',
+                          'shops', 'center', 'centre', 'general', 'pharmacy', 'mall', 'services', 'service'}
+
+# Shorter names are too ambiguous to be treated as truncations of longer ones
+MIN_TRUNCATED_LENGTH = 10
+
+
+def _is_noise(token):
+    return token in MERCHANT_SUFFIXES or bool(_STORE_NUMBER.fullmatch(token))
+
+
+def _is_variant(key, candidate):
+    """
+    Whether `key` is `candidate` cut at the width of the statement column
+    ('al aqsa gar and blanke'), or `candidate` followed by suffixes and
+    branch IDs. Other extra words make another merchant ('dubai mall
+    cinema' is not 'dubai mall').
+    """
+    if len(key) < MIN_TRUNCATED_LENGTH or len(candidate) < MIN_TRUNCATED_LENGTH:
+        return False
+    words, candidate_words = key.split(), candidate.split()
+    if len(words) > len(candidate_words):
+        return (words[:len(candidate_words)] == candidate_words
+                and all(_is_noise(word) for word in words[len(candidate_words):]))
+    # Cut in the middle of a word, the other words are the same
+    return (words[:-1] == candidate_words[:len(words) - 1]
+            and candidate_words[len(words) - 1] != words[-1]
+            and candidate_words[len(words) - 1].startswith(words[-1]))
+
+
+def normalize_merchant(name):
+    """
+    Lowercase a merchant name, drop punctuation, web domains and trailing
+    legal forms, branch markers and store numbers.
+
+    >>> normalize_merchant('NESTO HYPERMARKET LLC BRA ')
+    'nesto hypermarket'
+    """
+    text = _DOMAIN.sub(' ', name.lower()).replace('&', ' and ')
+    tokens = re.sub(r'[^a-z0-9# ]+', ' ', text).split()
+    while len(tokens) > 1:
+        if len(tokens) > 2 and tokens[-1].isdigit() and tokens[-2] in BRANCH_MARKERS:
+            del tokens[-2:]
+        elif _is_noise(tokens[-1]):
+            tokens.pop()
+        else:
+            break
+    return ' '.join(tokens)
+
+
+def _distinctive_words(key):
+    return {word for word in key.split() if word not in GENERIC_MERCHANT_WORDS and not _is_noise(word)}
+
+
+def _same_merchant(key, match):
+    """
+    Whether a fuzzy match is a spelling of the same merchant: the names only
+    differ by spaces ('lulu hyper market') or generic words and noise.
+    """
+    if key.replace(' ', '') == match.replace(' ', ''):
+        return True
+    words = _distinctive_words(key)
+    return bool(words) and words == _distinctive_words(match)
+
+
+class MerchantCanonicalizer:
+    """
+    Maps the spellings of a merchant on statements to one canonical key.
+
+    Names are normalized (see `normalize_merchant`), then matched against
+    the merchants seen before: a name that is a truncation of a known name
+    (see `_is_variant`), or close enough to one (difflib ratio), gets the
+    known key. Known merchants are loaded on first use, e.g. from the
+    merchant cache, so new spellings map to merchants that are already
+    classified.
+    """
+
+    def __init__(self, known=None, threshold=MERCHANT_MATCH_THRESHOLD):
+        self.known = known
+        self.threshold = threshold
+        self._canonical = {}
+        # Known keys by first word, the only ones compared with a new name
+        self._by_token = defaultdict(list)
+        self._keys = set()
+        self._loaded = known is None
+        self._lock = threading.RLock()
+
+    def _ensure_loaded(self):
+        with self._lock:
+            if self._loaded:
+                return
+            self._loaded = True
+            try:
+                for name in self.known():
+                    self._add(normalize_merchant(name))
+            except Exception as e:
+                logging.warning(f"Could not load the known merchants: {e}")
+
+    def _add(self, key):
+        if key and key not in self._keys:
+            self._keys.add(key)
+            self._by_token[key.split()[0]].append(key)
+
+    def _match(self, key):
+        candidates = self._by_token.get(key.split()[0], [])
+        for candidate in candidates:
+            if _is_variant(key, candidate):
+                return candidate
+        # A high ratio can come from long shared words alone ('al maha supermarket',
+        # 'al maya supermarket'), the distinctive words must be the same
+        for match in difflib.get_close_matches(key, candidates, n=3, cutoff=self.threshold):
+            if _same_merchant(key, match):
+                return match
+        return None
+
+    def canonical(self, name):
+        """Return the canonical key of a merchant name."""
+        self._ensure_loaded()
+        with self._lock:
+            if name in self._canonical:
+                return self._canonical[name]
+            key = normalize_merchant(name)
+            if key and key not in self._keys:
+                match = self._match(key)
+                if match is not None:
+                    key = match
+                else:
+                    self._add(key)
+            self._canonical[name] = key
+            return key
+
+    def canonicalize(self, names):
+        """
+        Map a Series of merchant names to their canonical keys. Each distinct
+        name is handled once, and a categorical Series stays categorical.
+        """
+        mapping = {name: self.canonical(name) for name in names.dropna().unique()}
+        keys = names.map(mapping)
+        if isinstance(names.dtype, pd.CategoricalDtype):
+            keys = keys.astype('category')
+        logging.info(f"Canonicalized {len(mapping)} merchant spellings into {len(set(mapping.values()))} merchants")
+        return keys
+
+
+merchant_canonicalizer = MerchantCanonicalizer(known=lambda: (merchant for merchant, _ in merchant_cache.items()))
@@ -0,0 +1,79 @@
+import logging
+import os
+import sqlite3
+import threading
+import pandas as pd
+from src.storage import read_table
+
+
+class QueryEngine:
+    """
+    Long-lived in-memory SQLite database for running SQL on a DataFrame.
+
+    The DataFrame is copied into the database once, when it is registered,
+    and every query runs against that copy. Registering the same DataFrame,
+    or the same unchanged file, again is a no-op.
+    """
+
+    def __init__(self, table='df'):
+        self.table = table
+        self.loads = 0
+        self.queries = 0
+        # The registered DataFrame, or the (path, mtime) of the registered file
+        self._frame = None
+        self._file = None
+        self._conn = sqlite3.connect(':memory:', check_same_thread=False)
+        self._lock = threading.Lock()
+
+    def _load(self, df, frame=None, file=None):
+        with self._lock:
+            df.to_sql(self.table, self._conn, if_exists='replace', index=False, chunksize=10000)
+            self._frame, self._file = frame, file
+            self.loads += 1
+        logging.info(f"Registered {len(df)} rows in the '{self.table}' query table")
+
+    def register(self, df):
+        """
+        Make `df` the data queried by the engine.
+
+        Returns:
+            bool: Whether the data was (re)loaded.
+        """
+        if df is self._frame:
+            return False
+        self._load(df, frame=df)
+        return True
+
+    def register_file(self, path):
+        """
+        Make the file at `path` (Parquet, or CSV) the data queried by the
+        engine. The file is only read again when its modification time changes.
+
+        Returns:
+            bool: Whether the data was (re)loaded.
+        """
+        key = (os.path.abspath(path), os.stat(path).st_mtime_ns)
+        if key == self._file:
+            return False
+        self._load(read_table(path), file=key)
+        return True
+
+    def mark_file(self, path):
+        """Record that the registered data is what was just written to `path`."""
+        with self._lock:
+            self._file = (os.path.abspath(path), os.stat(path).st_mtime_ns)
+
+    def query(self, sql):
+        """Run a query on the registered data and return its result as a DataFrame."""
+        with self._lock:
+            if self._frame is None and self._file is None:
+                raise RuntimeError("No data registered in the query engine")
+            self.queries += 1
+            return pd.read_sql_query(sql, self._conn)
+
+    def stats(self):
+        """Return how many times data was loaded, and how many queries ran."""
+        return {'loads': self.loads, 'queries': self.queries}
+
+
+query_engine = QueryEngine()
@@ -0,0 +1,31 @@
+import os
+import threading
+import pandas as pd
+
+# Columnar files keep the dtypes (datetimes, floats) of a DataFrame, so reading
+# one back does not parse text again
+PARQUET_COMPRESSION = os.getenv('SPENDWISE_PARQUET_COMPRESSION', 'snappy')
+
+
+def write_table(df, path, compression=PARQUET_COMPRESSION):
+    """
+    Save a DataFrame as a Parquet file.
+
+    The file is written next to `path` and renamed into place, so readers
+    never see a partial file.
+    """
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    df.to_parquet(tmp_path, index=False, compression=compression)
+    os.replace(tmp_path, path)
+    return path
+
+
+def read_table(path, columns=None):
+    """
+    Load a DataFrame saved by `write_table` (or a CSV file, by extension).
+
+    Parquet files are memory-mapped rather than read into a buffer first.
+    """
+    if path.endswith('.csv'):
+        return pd.read_csv(path, usecols=columns)
+    return pd.read_parquet(path, columns=columns, memory_map=True)